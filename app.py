@@ -1,16 +1,187 @@
+import logging
+import os
 import threading
+import time
+import uuid
 
-from flask import Flask, redirect, request
+from flask import Flask, Response, g, make_response, redirect, request
 from flask_cors import CORS, cross_origin
 
+import handlers
+import metrics
+import queries
+from batch import GroupCommit
+from cache import response_cache
 from database import *
+from exception import HashBusy, PoolTimeout, WriteTimeout
+from jobs import JobScheduler
+from pool import disconnected
 from semester import get_semester
+from serialize import dumps
+from versions import conditional
 
 app = Flask(__name__)
 cors = CORS(app)
 
 app.config['CORS_HEADER'] = 'Content-Type'
 
+http_max_age = int(os.environ.get('http_max_age', 60))
+update_workers = int(os.environ.get('update_workers', 2))
+update_history = int(os.environ.get('update_history', 100))
+update_schedule = os.environ.get('update_schedule', '')
+update_interval = float(os.environ.get('update_interval', 3600))
+# a job still queued after this long is taken to have lost its process
+update_job_timeout = float(os.environ.get('update_job_timeout', 3600))
+# group commit for POST /review: up to review_batch inserts, or whatever
+# arrives within review_batch_wait seconds, share one transaction; 0 disables
+review_batch = int(os.environ.get('review_batch', 0))
+review_batch_wait = float(os.environ.get('review_batch_wait', 0.005))
+# seconds a request waits for its batch to commit before answering 503
+review_batch_timeout = float(os.environ.get('review_batch_timeout', 10))
+
+# read-your-writes in every process: POST /review sets this cookie to a
+# signed, expiring pin, and reads that carry it go to primary
+PIN_COOKIE = 'read_primary'
+
+scheduler = JobScheduler(update, connection, update_workers, update_history, update_job_timeout)
+
+
+def bump_review_version(conn):
+    # after the reviews commit rather than in their transaction, where the
+    # shared row would serialize every review write; a reader may briefly get
+    # the new reviews under the old version, never the old under the new
+    try:
+        data_versions.bump(conn, ['review'])
+    except pg.Error:
+        logging.exception('review version bump failed')
+
+
+review_writer = GroupCommit(connection, review_batch, review_batch_wait,
+                            review_batch_timeout, bump_review_version) if review_batch else None
+schedule_pid = None
+schedule_lock = threading.Lock()
+
+
+@app.before_request
+def start_schedule():
+    # timer threads don't survive a fork, so the schedule starts with the
+    # first request each serving process handles; the scheduler keeps the
+    # processes from all submitting the same term
+    global schedule_pid
+    if not update_schedule or schedule_pid == os.getpid():
+        return
+    with schedule_lock:
+        if schedule_pid == os.getpid():
+            return
+        schedule_pid = os.getpid()
+        # e.g. update_schedule=2021:fall,2022:spring
+        terms = [term.split(':') for term in update_schedule.split(',')]
+        scheduler.schedule([(year, get_semester(semester)) for year, semester in terms],
+                           update_interval)
+
+
+metrics.cache_stats_hook('response', response_cache.stats)
+
+if snapshots is not None:
+    # maps whatever term snapshots are on disk (no database access); a
+    # preloading server shares the mappings with its workers
+    snapshots.warm()
+
+
+def request_token():
+    auth_header = request.headers.get('Authorization')
+    if not auth_header or ' ' not in auth_header:
+        return None
+    return auth_header.split(" ")[1]
+
+
+@app.before_request
+def start_request():
+    g.start = time.perf_counter()
+    metrics.begin_request()
+    # read-your-writes: a user who just posted reads from primary, past
+    # the response cache and ETags
+    g.read_primary = router.pinned(request_token(), request.cookies.get(PIN_COOKIE))
+
+
+@app.after_request
+def record_request(response):
+    # streamed bodies are timed to the first byte
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    count, seconds = metrics.end_request()
+    metrics.REQUEST_SECONDS.observe(time.perf_counter() - g.start,
+                                    route, request.method, response.status_code)
+    metrics.REQUEST_QUERIES.observe(count, route)
+    metrics.REQUEST_DB_SECONDS.observe(seconds, route)
+    return response
+
+
+@app.errorhandler(PoolTimeout)
+def database_busy(e):
+    return 'Database is busy, try again later', 503, {'Retry-After': '1'}
+
+
+@app.errorhandler(WriteTimeout)
+def write_timeout(e):
+    return 'Saving the review timed out, try again later', 503, {'Retry-After': '1'}
+
+
+@app.errorhandler(HashBusy)
+def hashing_busy(e):
+    return 'Too many login attempts in progress, try again later', 503, \
+        {'Retry-After': str(e.args[1])}
+
+
+STREAM_BATCH_SIZE = 2000
+
+
+def fetch(query, primary: bool):
+    with read_connection(primary) as conn, conn.cursor() as cur:
+        if query.stmt is not None:
+            queries.execute(cur, query.stmt, query.params[:-1], query.params[-1])
+        else:
+            cur.execute(query.sql, query.params)
+        return cur.fetchall()
+
+
+def run(handler):
+    # drives a handlers.py generator against the read connections
+    primary = g.get('read_primary', False)
+    try:
+        query = next(handler)
+        while True:
+            try:
+                results = fetch(query, primary)
+            except (pg.OperationalError, pg.InterfaceError) as e:
+                if not disconnected(e) and (primary or not router.replicas):
+                    raise
+                # reads are safe to repeat, once: on a fresh connection if
+                # the server dropped this one, and on primary if it was a
+                # replica (which was taken out of rotation if it went away)
+                results = fetch(query, True)
+            query = handler.send(results)
+    except StopIteration as e:
+        value = e.value
+
+    if isinstance(value, handlers.Stream):
+        return stream_rows(value, primary)
+    return value
+
+
+def stream_rows(stream, primary: bool = False):
+    def generate():
+        # a named cursor keeps the result set on the server and pulls it
+        # in batches, so memory stays flat regardless of the row count
+        with read_connection(primary) as conn:
+            with conn.cursor(name=f'stream_{uuid.uuid4().hex}') as cur:
+                cur.itersize = STREAM_BATCH_SIZE
+                cur.execute(stream.sql, stream.params)
+                for result in cur:
+                    yield dumps(stream.to_json(result))
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+
 @app.route('/')
 @cross_origin()
 def redirect_to_api():
@@ -51,166 +222,50 @@ def get_token():
 
 @app.route('/instructor', methods=['GET'])
 @cross_origin()
+@conditional(data_versions, handlers.catalog_versions, http_max_age)
+@response_cache.cached('instructor')
 def find_instructor():
-    email = request.args.get('email', default='%', type=str)
-    first_name = request.args.get('first_name', default='%', type=str)
-    middle_name = request.args.get('middle_name', default='%', type=str)
-    last_name = request.args.get('last_name', default='%', type=str)
-
-    check_connection()
-    with conn.cursor() as cur:
-        query = """\
-            SELECT * FROM instructor 
-            WHERE email ILIKE %s
-            AND first_name ILIKE %s
-            AND middle_name ILIKE %s
-            AND last_name ILIKE %s;"""
-        cur.execute(query, (email, first_name, middle_name, last_name))
-        if cur.rowcount != 0:
-            results = cur.fetchall()
-            l = []
-            for result in results:
-                l.append({
-                    "id": result[0],
-                    "email": result[1],
-                    "first_name": result[2],
-                    "middle_name": result[3],
-                    "last_name": result[4]
-                })
-            return {
-                "count": len(l),
-                "instructors": l
-            }
-        return 'No instructor was found with the given parameters', 204
+    return run(handlers.find_instructor(request.args, catalog))
 
 
 @app.route('/course', methods=['GET'])
 @cross_origin()
+@conditional(data_versions, handlers.catalog_versions, http_max_age)
+@response_cache.cached('course')
 def find_course():
-    subject = request.args.get('subject', default='%', type=str)
-    course_no = request.args.get('course_no', default='%')
-    if len(course_no) == 4:
-        course_no = course_no + " "
-
-    check_connection()
-    with conn.cursor() as cur:
-        query = """\
-            SELECT * FROM course 
-            WHERE subject ILIKE %s
-            AND course_no ILIKE %s;"""
-        cur.execute(query, (subject, course_no))
-        if cur.rowcount != 0:
-            results = cur.fetchall()
-            l = []
-            for result in results:
-                l.append({
-                    "id": result[0],
-                    "subject": result[1],
-                    "course_no": result[2],
-                    "title": result[3]
-                })
-            return {
-                "count": len(l),
-                "courses": l
-            }
-        return 'No course was found with the given parameters', 204
+    return run(handlers.find_course(request.args, catalog))
 
 
-@app.route('/teaching', methods=['GET'])
+@app.route('/course/batch', methods=['POST'])
 @cross_origin()
-def find_teaching():
-    instructor_id = request.args.get('instructor_id', default=None, type=int)
-    course_id = request.args.get('course_id', default=None, type=int)
-    year = request.args.get('year', default='%', type=str)
-    semester_raw = request.args.get('semester', default=None, type=str)
-
-    semester = None
-    if semester_raw:
-        semester = get_semester(semester_raw)
-        if semester is None:
-            return 'Provided semester is not valid', 400
-
-    check_connection()
-    with conn.cursor() as cur:
-        l = []
-
-        subquery = "SELECT * FROM teaching WHERE year LIKE %s"
-        t = []
-        t.append(year)
-
-        if semester:
-            subquery += " AND semester=%s"
-            t.append(semester.enum())
-
-        if instructor_id:
-            subquery += " AND instructor_id=%s"
-            t.append(instructor_id)
-
-        if course_id:
-            subquery += " AND course_id=%s"
-            t.append(course_id)
-
-        query = """\
-            SELECT  t.id,
-                    instructor_id, email, first_name, middle_name, last_name,
-                    course_id, subject, course_no, title,
-                    year, semester
-            FROM (""" + subquery + """) t
-            INNER JOIN instructor i ON t.instructor_id = i.id
-            INNER JOIN course c ON t.course_id = c.id;"""
-
-        cur.execute(query, tuple(t))
-        if cur.rowcount != 0:
-            results = cur.fetchall()
-            l = []
-            for result in results:
-                l.append({
-                    "id": result[0],
-                    "instructor": {
-                        "id": result[1],
-                        "email": result[2],
-                        "first_name": result[3],
-                        "middle_name": result[4],
-                        "last_name": result[5]
-                    },
-                    "course": {
-                        "id": result[6],
-                        "subject": result[7],
-                        "course_no": result[8],
-                        "title": result[9]
-                    },
-                    "year": result[10],
-                    "semester": result[11]
-                })
-            return {
-                "count": len(l),
-                "teachings": l
-            }
-        return 'No teaching was found with the given parameters', 204
+def find_courses():
+    return run(handlers.find_courses(request.args, request.get_json(force=True)))
 
 
-@app.route('/review', methods=['POST'])
+@app.route('/teaching', methods=['GET'])
 @cross_origin()
-def leave_review():
-    auth_header = request.headers.get('Authorization')
-    if not auth_header:
-        return 'Authorization token required', 401
+@conditional(data_versions, handlers.teaching_versions, http_max_age)
+@response_cache.cached('teaching')
+def find_teaching():
+    return run(handlers.find_teaching(request.args, snapshots))
 
-    auth_token = auth_header.split(" ")[1]
-    user_id = valid_token(auth_token)
 
-    if user_id is None:
-        return 'Provide token is not valid', 401
+REVIEW_INSERT = """\
+    INSERT INTO review (user_id, teaching_id, instructor_rating, difficulty_rating, comment)
+    VALUES (%s, %s, %s, %s, %s)
+    RETURNING id;"""
 
-    data = request.get_json(force=True)
+
+def review_values(user_id, data):
+    # (values, None) for REVIEW_INSERT, or (None, error response)
     if 'teaching_id' not in data:
-        return 'teaching_id is required', 400
+        return None, ('teaching_id is required', 400)
 
     if 'instructor_rating' not in data:
-        return 'instructor_rating is required', 400
+        return None, ('instructor_rating is required', 400)
 
     if 'difficulty_rating' not in data:
-        return 'difficulty_rating is required', 400
+        return None, ('difficulty_rating is required', 400)
 
     teaching_id = data['teaching_id']
     instructor_rating = data['instructor_rating']
@@ -221,134 +276,150 @@ def leave_review():
     else:
         comment = ''
 
-    check_connection()
-    with conn.cursor() as cur:
-        query = "SELECT id FROM teaching WHERE id=%s;"
-        cur.execute(query, (teaching_id,))
+    return (user_id, teaching_id, instructor_rating, difficulty_rating, comment), None
 
-        if cur.rowcount != 0:
-            query = """\
-                INSERT INTO review (user_id, teaching_id, instructor_rating, difficulty_rating, comment)
-                VALUES (%s, %s, %s, %s, %s)
-                RETURNING id;"""
 
-            try:
-                cur.execute(query, (user_id, teaching_id,
-                                    instructor_rating, difficulty_rating, comment))
-            except pg.Error as e:
-                conn.rollback()
-                error_code = e.pgcode
-                if error_code == "23505":
-                    return 'You have already posted the review on this teaching', 400
-                
-                if error_code == "23514":
-                    return 'Ratings should be between 1 to 5', 400
-                
-                return "Unknown Error", 400
-
-            review_id = cur.fetchone()[0]
-            conn.commit()
-            return {"review_id": review_id}
+def review_error(e, auth_token):
+    error_code = e.pgcode
+    if error_code == "23505":
+        return 'You have already posted the review on this teaching', 400
+
+    if error_code == "23514":
+        return 'Ratings should be between 1 to 5', 400
+
+    # fk_teach rejects unknown teaching ids, so no separate lookup is needed
+    if error_code == "23503" and e.diag.constraint_name == 'fk_teach':
         return 'Provided teaching_id is invalid', 400
 
+    # the user was deleted while their token was still cached
+    if error_code == "23503" and e.diag.constraint_name == 'fk_user':
+        token_cache.delete(auth_token)
+        return 'Provide token is not valid', 401
+
+    return "Unknown Error", 400
+
+
+def reviewed(review_id, auth_token):
+    response_cache.invalidate('review', 'stats')
+    response = make_response({"review_id": review_id})
+    pin = router.pin(auth_token)
+    if pin is not None:
+        response.set_cookie(PIN_COOKIE, pin, max_age=int(router.pin_ttl) + 1, httponly=True)
+    return response
+
+
+@app.route('/review', methods=['POST'])
+@cross_origin()
+def leave_review():
+    auth_header = request.headers.get('Authorization')
+    if not auth_header:
+        return 'Authorization token required', 401
+
+    auth_token = auth_header.split(" ")[1]
+
+    if review_writer is not None:
+        # the insert is queued and committed together with other requests';
+        # a token cache miss checks out its own connection
+        user_id = valid_token(auth_token)
+        if user_id is None:
+            return 'Provide token is not valid', 401
+
+        values, error = review_values(user_id, request.get_json(force=True))
+        if error:
+            return error
+
+        try:
+            review_id = review_writer.execute(REVIEW_INSERT, values)[0]
+        except pg.Error as e:
+            return review_error(e, auth_token)
+        return reviewed(review_id, auth_token)
+
+    with connection() as conn, conn.cursor() as cur:
+        # a cached token costs no query; otherwise it's checked on the same
+        # connection that runs the insert
+        user_id = valid_token(auth_token, cur)
+
+        if user_id is None:
+            return 'Provide token is not valid', 401
+
+        values, error = review_values(user_id, request.get_json(force=True))
+        if error:
+            return error
+
+        try:
+            cur.execute(REVIEW_INSERT, values)
+        except pg.Error as e:
+            conn.rollback()
+            return review_error(e, auth_token)
+
+        review_id = cur.fetchone()[0]
+        conn.commit()
+        bump_review_version(conn)
+    return reviewed(review_id, auth_token)
+
 
 @app.route('/review', methods=['GET'])
 @cross_origin()
+@conditional(data_versions, handlers.review_versions, http_max_age)
+@response_cache.cached('review')
 def get_review():
-    instructor_id = request.args.get('instructor_id', default=None, type=int)
-    course_id = request.args.get('course_id', default=None, type=int)
-    year = request.args.get('year', default='%', type=str)
-    semester_raw = request.args.get('semester', default=None, type=str)
-
-    semester = None
-    if semester_raw:
-        semester = get_semester(semester_raw)
-        if semester is None:
-            return 'Provided semester is not valid', 400
-
-    check_connection()
-    with conn.cursor() as cur:
-        l = []
-
-        query = """\
-            SELECT
-	            e.id, 
-                i.id, i.email, i.first_name, i.middle_name, i.last_name,
-                c.id, c.subject, c.course_no, c.title,
-                e.year, e.semester,
-                e.instructor_rating, e.difficulty_rating, e.comment
-            FROM 
-                (
-                    SELECT
-                        t.instructor_id, t.course_id, t.year, t.semester,
-                        r.id, r.instructor_rating, r.difficulty_rating, r.comment
-                    FROM
-                        (SELECT * FROM review) r
-                        INNER JOIN teaching t ON t.id = r.teaching_id
-                ) e
-                INNER JOIN instructor i ON e.instructor_id = i.id
-                INNER JOIN course c ON e.course_id = c.id
-            WHERE
-                e.year LIKE %s"""
-
-        t = []
-        t.append(year)
-
-        if semester:
-            query += " AND semester=%s"
-            t.append(semester.enum())
-
-        if instructor_id:
-            query += " AND instructor_id=%s"
-            t.append(instructor_id)
-
-        if course_id:
-            query += " AND course_id=%s"
-            t.append(course_id)
-
-        cur.execute(query, tuple(t))
-        if cur.rowcount != 0:
-            results = cur.fetchall()
-            l = []
-            for result in results:
-                l.append({
-                    "id": result[0],
-                    "teaching": {
-                        "instructor": {
-                            "id": result[1],
-                            "email": result[2],
-                            "first_name": result[3],
-                            "middle_name": result[4],
-                            "last_name": result[5]
-                        },
-                        "course": {
-                            "id": result[6],
-                            "subject": result[7],
-                            "course_no": result[8],
-                            "title": result[9]
-                        },
-                        "year": result[10],
-                        "semester": result[11]
-                    },
-                    "instructor_rating": result[12],
-                    "difficulty_rating": result[13],
-                    "comment": result[14]
-                })
-            return {
-                "count": len(l),
-                "reviews": l
-            }
-        return 'No review was found with the given parameters', 204
+    return run(handlers.get_review(request.args))
+
+
+@app.route('/instructor/<int:instructor_id>/stats', methods=['GET'])
+@cross_origin()
+@conditional(data_versions, handlers.stats_versions, http_max_age)
+@response_cache.cached('stats')
+def instructor_stats(instructor_id):
+    return run(handlers.rating_stats('I', instructor_id))
+
+
+@app.route('/course/<int:course_id>/stats', methods=['GET'])
+@cross_origin()
+@conditional(data_versions, handlers.stats_versions, http_max_age)
+@response_cache.cached('stats')
+def course_stats(course_id):
+    return run(handlers.rating_stats('C', course_id))
+
+
+@app.route('/teaching/<int:teaching_id>/stats', methods=['GET'])
+@cross_origin()
+@conditional(data_versions, handlers.stats_versions, http_max_age)
+@response_cache.cached('stats')
+def teaching_stats(teaching_id):
+    return run(handlers.rating_stats('T', teaching_id))
+
+
+@app.route('/cache/stats', methods=['GET'])
+@cross_origin()
+def cache_stats():
+    return response_cache.stats()
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    # per process; each worker of a prefork server reports its own
+    return metrics.registry.render(), 200, {'Content-Type': metrics.CONTENT_TYPE}
 
 
 @app.route('/update/<string:year>/<string:semester_raw>')
 @cross_origin()
 def update_courses(year, semester_raw):
+    if not (len(year) == 4 and year.isdigit()):
+        return 'Provided year is not valid', 400
+
     semester = get_semester(semester_raw)
     if semester is None:
         return 'Provided semester is not valid', 400
 
-    t = threading.Thread(target=update, args=(year, semester))
-    t.start()
+    job = scheduler.submit(year, semester)
+    return {"job_id": job.id, "status": job.status}, 202
 
-    return f'Database update requested', 200
+
+@app.route('/update/jobs/<string:job_id>')
+@cross_origin()
+def update_job(job_id):
+    job = scheduler.get(job_id)
+    if job is None:
+        return 'No update job was found with the given id', 404
+    return job.to_json()
@@ -0,0 +1,294 @@
+import asyncio
+import json
+import logging
+import re
+import time
+import uuid
+from contextlib import AsyncExitStack, asynccontextmanager
+from urllib.parse import parse_qsl
+
+import psycopg
+from asgiref.wsgi import WsgiToAsgi
+from psycopg.conninfo import make_conninfo
+from psycopg_pool import AsyncConnectionPool, PoolTimeout
+from werkzeug.datastructures import MultiDict
+from werkzeug.http import parse_cookie, parse_etags
+
+import database
+import handlers
+import metrics
+from app import PIN_COOKIE, app as wsgi_app, http_max_age
+from cache import response_cache
+from pool import disconnected
+from serialize import dumps
+from versions import etag
+
+STREAM_BATCH_SIZE = 2000
+# refreshed off the event loop this long before DataVersions.get() would
+# refresh inline
+VERSION_REFRESH_MARGIN = 1
+
+# Read endpoints run on asyncio with psycopg 3; everything else (writes,
+# /update, /cache/stats, ...) is served by the Flask app through asgiref.
+#   uvicorn asgi:app --port 4371
+ROUTES = [
+    (re.compile(r'/instructor'), '/instructor', 'instructor', handlers.catalog_versions,
+     lambda args, m: handlers.find_instructor(args, database.catalog)),
+    (re.compile(r'/course'), '/course', 'course', handlers.catalog_versions,
+     lambda args, m: handlers.find_course(args, database.catalog)),
+    (re.compile(r'/teaching'), '/teaching', 'teaching', handlers.teaching_versions,
+     lambda args, m: handlers.find_teaching(args, database.snapshots)),
+    (re.compile(r'/review'), '/review', 'review', handlers.review_versions,
+     lambda args, m: handlers.get_review(args)),
+    (re.compile(r'/instructor/(\d+)/stats'), '/instructor/<int:instructor_id>/stats', 'stats',
+     handlers.stats_versions, lambda args, m: handlers.rating_stats('I', int(m[1]))),
+    (re.compile(r'/course/(\d+)/stats'), '/course/<int:course_id>/stats', 'stats',
+     handlers.stats_versions, lambda args, m: handlers.rating_stats('C', int(m[1]))),
+    (re.compile(r'/teaching/(\d+)/stats'), '/teaching/<int:teaching_id>/stats', 'stats',
+     handlers.stats_versions, lambda args, m: handlers.rating_stats('T', int(m[1]))),
+]
+
+
+def _conninfo(host, port):
+    return make_conninfo(dbname=database.dbname, host=host, port=port,
+                         user=database.user, password=database.password,
+                         connect_timeout=database.connect_timeout)
+
+
+conninfo = _conninfo(database.host, database.port)
+replica_conninfos = [_conninfo(replica.partition(':')[0], replica.partition(':')[2] or database.port)
+                     for replica in database.replicas]
+pool = None
+replica_pools = []
+fallback = WsgiToAsgi(wsgi_app)
+
+
+async def _open_pool():
+    global pool, replica_pools
+    if pool is None:
+        pool = AsyncConnectionPool(conninfo, min_size=database.pool_min,
+                                   max_size=database.pool_max,
+                                   timeout=database.pool_timeout, open=False)
+        replica_pools = [AsyncConnectionPool(info, min_size=0, max_size=database.pool_max,
+                                             timeout=database.pool_timeout, open=False)
+                         for info in replica_conninfos]
+        for p in (pool, *replica_pools):
+            await p.open()
+
+
+@asynccontextmanager
+async def read_connection(primary: bool):
+    # database.router picks the replica and tracks which are down, as for
+    # the WSGI app; psycopg_pool retries connecting in the background, so
+    # here a replica that can't hand out a connection in time counts as down
+    router = database.router
+    for index in ([] if primary else router.candidates()):
+        stack = AsyncExitStack()
+        try:
+            conn = await stack.enter_async_context(replica_pools[index].connection())
+        except (psycopg.OperationalError, PoolTimeout) as e:
+            router.mark_down(index, e)
+            continue
+
+        async with stack:
+            try:
+                yield conn
+            except (psycopg.OperationalError, psycopg.InterfaceError) as e:
+                if conn.closed:
+                    router.mark_down(index, e)
+                raise
+        metrics.DB_READS.inc('replica')
+        return
+
+    async with pool.connection() as conn:
+        yield conn
+    metrics.DB_READS.inc('primary')
+
+
+async def fetch(query, primary: bool):
+    async with read_connection(primary) as conn, conn.cursor() as cur:
+        await cur.execute(query.sql, query.params)
+        return await cur.fetchall()
+
+
+async def run(handler, route: str, primary: bool = False):
+    # drives a handlers.py generator against the async pools; psycopg 3
+    # prepares repeated statements on its own (prepare_threshold)
+    count, seconds = 0, 0.0
+    try:
+        query = next(handler)
+        while True:
+            start = time.perf_counter()
+            try:
+                results = await fetch(query, primary)
+            except (psycopg.OperationalError, psycopg.InterfaceError) as e:
+                if not disconnected(e) and (primary or not replica_pools):
+                    raise
+                # psycopg_pool discards a broken connection when it's
+                # returned, so the retry gets a working one
+                results = await fetch(query, True)
+            elapsed = time.perf_counter() - start
+            metrics.observe_query(query.sql, elapsed)
+            count, seconds = count + 1, seconds + elapsed
+            query = handler.send(results)
+    except StopIteration as e:
+        return e.value
+    finally:
+        metrics.REQUEST_QUERIES.observe(count, route)
+        metrics.REQUEST_DB_SECONDS.observe(seconds, route)
+
+
+def _encode(value):
+    # mirrors how Flask turns a view's return value into a response
+    status, headers = 200, dict()
+    if isinstance(value, tuple):
+        value, status, *rest = value
+        if rest:
+            headers = dict(rest[0])
+
+    if isinstance(value, dict):
+        body = (json.dumps(value, sort_keys=True, separators=(',', ':')) + '\n').encode('utf-8')
+        headers.setdefault('Content-Type', 'application/json')
+    elif isinstance(value, str):
+        body = value.encode('utf-8')
+        headers.setdefault('Content-Type', 'text/html; charset=utf-8')
+    else:
+        body = value
+
+    if status == 204:
+        body = b''
+    elif isinstance(body, bytes):
+        headers['Content-Length'] = len(body)
+    return status, headers, body
+
+
+async def _start(send, status, headers, origin):
+    # as flask_cors answers a cross_origin() view
+    if origin:
+        headers['Access-Control-Allow-Origin'] = origin.decode('latin-1')
+        headers['Vary'] = 'Origin'
+    else:
+        headers['Access-Control-Allow-Origin'] = '*'
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(k.lower().encode('latin-1'), str(v).encode('latin-1'))
+                    for k, v in headers.items()]
+    })
+
+
+async def _stream(send, stream, origin, primary: bool, cache_headers):
+    await _start(send, 200, {'Content-Type': 'application/x-ndjson', **cache_headers}, origin)
+    async with read_connection(primary) as conn:
+        async with conn.cursor(name=f'stream_{uuid.uuid4().hex}') as cur:
+            cur.itersize = STREAM_BATCH_SIZE
+            await cur.execute(stream.sql, stream.params)
+            async for result in cur:
+                await send({'type': 'http.response.body',
+                            'body': dumps(stream.to_json(result)), 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def _load_catalog():
+    # the first catalog.snapshot() loads both tables, which mustn't hold up
+    # the event loop; later reloads already happen on their own thread
+    catalog = database.catalog
+    if catalog is not None and not catalog.ready:
+        await asyncio.to_thread(catalog.snapshot)
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await _open_pool()
+            try:
+                await _load_catalog()
+            except Exception:
+                # the first request tries again
+                logging.exception('catalog load failed')
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if pool is not None:
+                for p in (pool, *replica_pools):
+                    await p.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await _lifespan(receive, send)
+
+    if scope['type'] != 'http' or scope['method'] != 'GET':
+        return await fallback(scope, receive, send)
+
+    for pattern, rule, namespace, names, route in ROUTES:
+        match = pattern.fullmatch(scope['path'])
+        if match:
+            break
+    else:
+        return await fallback(scope, receive, send)
+
+    start = time.perf_counter()
+    await _open_pool()
+    await _load_catalog()
+    headers = dict(scope['headers'])
+    origin = headers.get(b'origin')
+    query_string = scope['query_string'].decode('latin-1')
+    args = MultiDict(parse_qsl(query_string, keep_blank_values=True))
+    # read-your-writes, for posts made through the fallback
+    auth_header = headers.get(b'authorization', b'').decode('latin-1').split(' ')
+    cookies = parse_cookie(headers.get(b'cookie', b'').decode('latin-1'))
+    primary = database.router.pinned(auth_header[1] if len(auth_header) > 1 else None,
+                                     cookies.get(PIN_COOKIE))
+
+    # the versions are read here and by snapshots.get(), pinned callers
+    # included; refreshing them inline would hold up the event loop
+    versions = database.data_versions
+    if versions.stale(VERSION_REFRESH_MARGIN):
+        await asyncio.to_thread(versions.refresh)
+
+    # versions.conditional and then response_cache.cached, as app.py
+    # applies them; both skipped for a pinned caller, whose write the
+    # versions may not show yet
+    cache_headers, key, value = dict(), None, None
+    if not primary:
+        version = versions.get(names(args))
+        tag = etag(scope['path'], args, version)
+        cache_headers = {'ETag': f'"{tag}"', 'Cache-Control': f'public, max-age={http_max_age}'}
+        if_none_match = headers.get(b'if-none-match')
+        if if_none_match and parse_etags(if_none_match.decode('latin-1')).contains_weak(tag):
+            await _start(send, 304, cache_headers, origin)
+            await send({'type': 'http.response.body', 'body': b''})
+            metrics.REQUEST_SECONDS.observe(time.perf_counter() - start, rule, 'GET', 304)
+            return
+
+        if response_cache.enabled and args.get('format') != 'ndjson':
+            key = response_cache.key(namespace, scope['path'], args, version)
+            value = response_cache.lookup(namespace, key)
+
+    if value is None:
+        try:
+            value = await run(route(args, match), rule, primary)
+            if key is not None:
+                response_cache.store(key, value)
+        except PoolTimeout:
+            value = 'Database is busy, try again later', 503, {'Retry-After': '1'}
+
+    if isinstance(value, handlers.Stream):
+        # timed to the first byte, as in app.py
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - start, rule, 'GET', 200)
+        return await _stream(send, value, origin, primary, cache_headers)
+
+    status, headers, body = _encode(value)
+    if status == 200:
+        headers.update(cache_headers)
+    await _start(send, status, headers, origin)
+    if not isinstance(body, bytes):
+        # a snapshot's ndjson, in chunks straight from its mapping
+        for chunk in body:
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        body = b''
+    await send({'type': 'http.response.body', 'body': body})
+    metrics.REQUEST_SECONDS.observe(time.perf_counter() - start, rule, 'GET', status)
@@ -0,0 +1,117 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+from typing import Callable, List, Tuple
+
+import psycopg2 as pg
+
+import metrics
+from exception import WriteTimeout
+
+
+class GroupCommit:
+    # Write-behind path for single-statement writes: callers queue a
+    # statement and block, a background thread runs up to max_batch of them
+    # (or whatever arrived within max_wait seconds) in one transaction and
+    # commits once. Each statement runs under its own savepoint, so one
+    # failing only fails its own caller. Callers wait at most timeout
+    # seconds. on_commit runs once per batch, after the commit, on the same
+    # connection.
+    def __init__(self, connect: Callable, max_batch: int, max_wait: float,
+                 timeout: float, on_commit: Callable = None) -> None:
+        self.connect = connect
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.timeout = timeout
+        self.on_commit = on_commit
+
+        self._queue = None
+        self._pid = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        # the writer thread doesn't survive a fork; each process runs its
+        # own, and starts another if it died
+        pid = os.getpid()
+        if self._pid == pid and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == pid and self._thread.is_alive():
+                return
+            if self._pid != pid:
+                self._queue = queue.Queue()
+            self._thread = threading.Thread(target=self._run, name='group-commit', daemon=True)
+            self._thread.start()
+            self._pid = pid
+
+    def execute(self, query: str, params: tuple):
+        # returns the statement's first row once it has been committed, or
+        # raises the error it (or the commit) failed with
+        self._start()
+        future = Future()
+        self._queue.put((query, params, future))
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            # still queued, it's dropped; already running, it may yet commit
+            future.cancel()
+            raise WriteTimeout(f'no commit within {self.timeout}s')
+
+    def _batch(self) -> List[Tuple[str, tuple, Future]]:
+        items = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(items) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                items.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return items
+
+    def _run(self):
+        while True:
+            items = self._batch()
+            try:
+                self._commit(items)
+            except Exception as e:
+                for _, _, future in items:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _commit(self, items: List[Tuple[str, tuple, Future]]):
+        # skips the statements whose callers gave up waiting
+        items = [item for item in items if item[2].set_running_or_notify_cancel()]
+        if not items:
+            return
+
+        outcomes = []
+        with self.connect() as conn, conn.cursor() as cur:
+            for query, params, future in items:
+                cur.execute("SAVEPOINT group_commit;")
+                try:
+                    cur.execute(query, params)
+                    outcomes.append((future, cur.fetchone(), None))
+                    cur.execute("RELEASE SAVEPOINT group_commit;")
+                except pg.Error as e:
+                    if conn.closed:
+                        raise
+                    cur.execute("ROLLBACK TO SAVEPOINT group_commit;")
+                    outcomes.append((future, None, e))
+
+            start = time.perf_counter()
+            conn.commit()
+            metrics.GROUP_COMMIT_SECONDS.observe(time.perf_counter() - start)
+            if self.on_commit is not None and any(error is None for _, _, error in outcomes):
+                self.on_commit(conn)
+        metrics.GROUP_COMMIT_SIZE.observe(len(items))
+
+        for future, row, error in outcomes:
+            if error is None:
+                future.set_result(row)
+            else:
+                future.set_exception(error)
@@ -0,0 +1,904 @@
+import argparse
+import functools
+import hashlib
+import html
+import itertools
+import json
+import operator
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import timeit
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import psycopg2 as pg
+import requests
+from psycopg2.extensions import parse_dsn
+
+from flask import Flask, jsonify
+
+import course
+import serialize
+from semester import FALL
+
+CHUNK_SIZE = 64 * 1024
+REPO = os.path.dirname(os.path.abspath(__file__))
+
+
+def _chunks(html: str):
+    for i in range(0, len(html), CHUNK_SIZE):
+        yield html[i:i + CHUNK_SIZE]
+
+
+def bench_parse(paths, number: int = 5) -> dict:
+    results = dict()
+    for path in paths:
+        with open(path, 'r') as file:
+            html = file.read()
+
+        soup = course.parse_sections(html)
+        stream = set(course.iter_sections(_chunks(html)))
+        if soup != stream:
+            raise AssertionError(f'{path}: parsers disagree ({len(soup)} vs {len(stream)} sections)')
+
+        soup_time = timeit.timeit(lambda: course.parse_sections(html), number=number) / number
+        stream_time = timeit.timeit(lambda: set(course.iter_sections(_chunks(html))),
+                                    number=number) / number
+        results[path] = {
+            "bytes": len(html),
+            "sections": len(soup),
+            "soup_seconds": soup_time,
+            "stream_seconds": stream_time,
+            "speedup": soup_time / stream_time
+        }
+    return results
+
+
+def _review_json(result):
+    # the builder app.py used before serialize.py
+    return {
+        "id": result[0],
+        "teaching": {
+            "instructor": {
+                "id": result[1],
+                "email": result[2],
+                "first_name": result[3],
+                "middle_name": result[4],
+                "last_name": result[5]
+            },
+            "course": {
+                "id": result[6],
+                "subject": result[7],
+                "course_no": result[8],
+                "title": result[9]
+            },
+            "year": result[10],
+            "semester": result[11]
+        },
+        "instructor_rating": result[12],
+        "difficulty_rating": result[13],
+        "comment": result[14]
+    }
+
+
+def _itemgetter_mapper(schema, index: int = 0):
+    # serialize.row_mapper without the generated source, kept to measure
+    # what the codegen buys
+    fields = []
+    for field in schema:
+        if isinstance(field, tuple):
+            name, nested = field
+            get, index = _itemgetter_mapper(nested, index)
+        else:
+            name, get = field, operator.itemgetter(index)
+            index += 1
+        fields.append((name, get))
+    fields.sort(key=operator.itemgetter(0))
+    names = tuple(name for name, _ in fields)
+    getters = tuple(get for _, get in fields)
+    return (lambda r: dict(zip(names, [get(r) for get in getters]))), index
+
+
+def _review_rows(n: int):
+    return [(i, i % 997, f'i{i % 997}@uga.edu', 'First', 'M', 'Last',
+             i % 4001, 'CSCI', '1302 ', 'Software Development', '2021', 'F',
+             i % 5 + 1, (i * 7) % 5 + 1, 'Great course, would take again \u2713' * (i % 3))
+            for i in range(n)]
+
+
+def bench_serialize(rows: int = 10_000, number: int = 5) -> dict:
+    app = Flask(__name__)
+    results = _review_rows(rows)
+
+    def flask_path():
+        l = [_review_json(result) for result in results]
+        return jsonify({"count": len(l), "reviews": l}).get_data()
+
+    def serialize_path():
+        l = [serialize.review_json(result) for result in results]
+        return serialize.json_response({"count": len(l), "reviews": l})[0]
+
+    review_json, _ = _itemgetter_mapper(serialize.REVIEW)
+
+    def itemgetter_path():
+        l = [review_json(result) for result in results]
+        return serialize.json_response({"count": len(l), "reviews": l})[0]
+
+    def columns_path():
+        return serialize.json_response({"count": len(results),
+                                        "reviews": serialize.to_columns(serialize.REVIEW, results)})[0]
+
+    with app.app_context():
+        identical = flask_path() == serialize_path() == itemgetter_path()
+        timings = {
+            name: timeit.timeit(f, number=number) / number
+            for name, f in (('flask', flask_path), ('serialize', serialize_path),
+                            ('itemgetter', itemgetter_path), ('columns', columns_path))
+        }
+
+    return {
+        "rows": rows,
+        "encoder": serialize.json_encoder,
+        "identical": identical,
+        "seconds": timings,
+        "bytes": {"rows": len(serialize_path()), "columns": len(columns_path())}
+    }
+
+
+def _percentile(samples, p: float) -> float:
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+def _drive(base_url: str, make_request, concurrency: int, duration: float) -> dict:
+    # calls make_request(session, base_url, i) from `concurrency` threads
+    # until the deadline; i counts up from each thread's offset
+    latencies = []
+    statuses = Counter()
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker(offset):
+        session = requests.Session()
+        local, codes, i = [], Counter(), offset
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                codes[make_request(session, base_url, i).status_code] += 1
+            except requests.RequestException:
+                codes['error'] += 1
+            local.append(time.perf_counter() - start)
+            i += concurrency
+        with lock:
+            latencies.extend(local)
+            statuses.update(codes)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return {
+        "requests": len(latencies),
+        "errors": sum(n for code, n in statuses.items() if code == 'error' or code >= 500),
+        "statuses": {str(code): n for code, n in sorted(statuses.items(), key=str)},
+        "rps": len(latencies) / duration,
+        "p50": _percentile(latencies, 0.50),
+        "p99": _percentile(latencies, 0.99)
+    }
+
+
+def bench_load(targets: dict, paths, concurrency: int = 16, duration: float = 10) -> dict:
+    # drives every path round-robin against each target (name -> base url)
+    # in turn
+    def get(session, base_url, i):
+        return session.get(base_url + paths[i % len(paths)])
+
+    return {name: _drive(base_url, get, concurrency, duration)
+            for name, base_url in targets.items()}
+
+
+# Synthetic data set; row i of each table is derived from i alone, so the
+# endpoint benchmark can build valid requests from the same scale arguments.
+SEED_PASSWORD = 'benchmark'
+FIRST_NAMES = ['James', 'Mary', 'Robert', 'Patricia', 'John', 'Jennifer', 'Michael', 'Linda',
+               'David', 'Elizabeth', 'William', 'Barbara', 'Richard', 'Susan', 'Joseph', 'Jessica']
+TERMS = [(str(year), semester) for year in range(2015, 2023) for semester in ('S', 'X', 'F')]
+
+
+# Benchmarks that touch a database get one of their own (--dsn or bench_dsn):
+# seeding truncates every table, and the others write to it.
+LOCAL_HOSTS = ('', 'localhost', '127.0.0.1', '::1')
+
+
+def _database_key(params: dict) -> tuple:
+    host = params.get('host') or ''
+    if host in LOCAL_HOSTS or host.startswith('/'):
+        host = 'localhost'
+    return host, str(params.get('port') or 5432), params.get('dbname')
+
+
+def _check_dsn(dsn: str) -> str:
+    import database
+
+    if not dsn:
+        raise ValueError('a benchmark database is required (--dsn or bench_dsn)')
+    if _database_key(parse_dsn(dsn)) == _database_key({'host': database.host, 'port': database.port,
+                                                       'dbname': database.dbname}):
+        raise ValueError('refusing to benchmark against the database the app is configured with')
+    return dsn
+
+
+@contextmanager
+def _connection(dsn: str):
+    conn = pg.connect(dsn)
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+def _check_scale(scale: dict):
+    # each teaching pairs its instructor with a distinct course, each review
+    # its user with a distinct teaching
+    if scale['teachings'] > scale['instructors'] * scale['courses']:
+        raise ValueError('teachings cannot exceed instructors * courses')
+    if scale['reviews'] > scale['users'] * scale['teachings']:
+        raise ValueError('reviews cannot exceed users * teachings')
+
+
+def bench_seed(dsn: str, scale: dict, force: bool = False) -> dict:
+    import login
+
+    _check_dsn(dsn)
+    _check_scale(scale)
+    key, salt = login.hash(SEED_PASSWORD)
+    timings = dict()
+
+    with _connection(dsn) as conn, conn.cursor() as cur:
+        cur.execute("SELECT to_regclass('teaching') IS NULL;")
+        if cur.fetchone()[0]:
+            with open(os.path.join(REPO, 'setup.sql'), 'r') as file:
+                cur.execute(file.read())
+        elif not force:
+            cur.execute("""\
+                SELECT EXISTS (SELECT 1 FROM instructor) OR EXISTS (SELECT 1 FROM course)
+                    OR EXISTS (SELECT 1 FROM user_info) OR EXISTS (SELECT 1 FROM review);""")
+            if cur.fetchone()[0]:
+                raise ValueError('the benchmark database already has data; --force replaces it')
+
+        start = time.perf_counter()
+        cur.execute("""\
+            TRUNCATE review_feed, review, teaching, course, instructor, user_info,
+                     rating_summary, term_fingerprint, data_version
+            RESTART IDENTITY CASCADE;""")
+        timings['truncate'] = time.perf_counter() - start
+
+        steps = [
+            ('instructors', """\
+                INSERT INTO instructor (email, first_name, middle_name, last_name)
+                SELECT  'instructor' || i || '@uga.edu',
+                        (%(first_names)s::VARCHAR[])[1 + i %% array_length(%(first_names)s::VARCHAR[], 1)],
+                        CASE WHEN i %% 3 = 0 THEN 'M' END,
+                        'Last' || i
+                FROM generate_series(0, %(instructors)s - 1) i;"""),
+            ('courses', """\
+                INSERT INTO course (subject, course_no, title)
+                SELECT  (%(subjects)s::CHAR(4)[])[1 + i %% array_length(%(subjects)s::CHAR(4)[], 1)],
+                        (1000 + i / array_length(%(subjects)s::CHAR(4)[], 1)) || ' ',
+                        'Synthetic Course ' || i
+                FROM generate_series(0, %(courses)s - 1) i;"""),
+            ('teachings', """\
+                INSERT INTO teaching (instructor_id, course_id, year, semester)
+                SELECT  1 + i %% %(instructors)s,
+                        1 + (i / %(instructors)s + (i %% %(instructors)s) * 37) %% %(courses)s,
+                        (%(years)s::CHAR(4)[])[1 + i %% %(terms)s],
+                        (%(semesters)s::SEMESTER[])[1 + i %% %(terms)s]
+                FROM generate_series(0, %(teachings)s - 1) i;"""),
+            ('users', """\
+                INSERT INTO user_info (username, token, password, salt, hash_scheme)
+                SELECT 'user' || i, md5('token' || i), %(key)s, %(salt)s, %(scheme)s
+                FROM generate_series(0, %(users)s - 1) i;"""),
+            ('reviews', """\
+                INSERT INTO review (user_id, teaching_id, instructor_rating, difficulty_rating, comment)
+                SELECT  1 + i %% %(users)s,
+                        1 + (i / %(users)s + (i %% %(users)s) * 37) %% %(teachings)s,
+                        1 + i %% 5,
+                        1 + (i * 7) %% 5,
+                        CASE WHEN i %% 4 = 0 THEN 'Synthetic review ' || i END
+                FROM generate_series(0, %(reviews)s - 1) i;"""),
+        ]
+        params = dict(scale, key=key, salt=salt, scheme=login.CURRENT_SCHEME,
+                      first_names=FIRST_NAMES, subjects=list(course.SUBJECTS),
+                      years=[year for year, _ in TERMS],
+                      semesters=[semester for _, semester in TERMS], terms=len(TERMS))
+
+        # the per-row summary and feed triggers would dominate a bulk load;
+        # both are rebuilt in one pass afterwards instead
+        cur.execute("ALTER TABLE review DISABLE TRIGGER USER;")
+        for name, query in steps:
+            start = time.perf_counter()
+            cur.execute(query, params)
+            timings[name] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        cur.execute("""\
+            INSERT INTO rating_summary (scope, target_id, review_count,
+                                        instructor_rating_sum, difficulty_rating_sum,
+                                        instructor_histogram, difficulty_histogram)
+            SELECT  s.scope, s.target_id, COUNT(*),
+                    SUM(r.instructor_rating), SUM(r.difficulty_rating),
+                    ARRAY[COUNT(*) FILTER (WHERE r.instructor_rating = 1),
+                          COUNT(*) FILTER (WHERE r.instructor_rating = 2),
+                          COUNT(*) FILTER (WHERE r.instructor_rating = 3),
+                          COUNT(*) FILTER (WHERE r.instructor_rating = 4),
+                          COUNT(*) FILTER (WHERE r.instructor_rating = 5)],
+                    ARRAY[COUNT(*) FILTER (WHERE r.difficulty_rating = 1),
+                          COUNT(*) FILTER (WHERE r.difficulty_rating = 2),
+                          COUNT(*) FILTER (WHERE r.difficulty_rating = 3),
+                          COUNT(*) FILTER (WHERE r.difficulty_rating = 4),
+                          COUNT(*) FILTER (WHERE r.difficulty_rating = 5)]
+            FROM review r
+            INNER JOIN teaching t ON t.id = r.teaching_id,
+            LATERAL (VALUES ('T', t.id), ('I', t.instructor_id), ('C', t.course_id)) s (scope, target_id)
+            GROUP BY s.scope, s.target_id;""")
+        timings['rating_summary'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        cur.execute("""\
+            INSERT INTO review_feed
+            SELECT  r.id,
+                    i.id, i.email, i.first_name, i.middle_name, i.last_name,
+                    c.id, c.subject, c.course_no, c.title,
+                    t.year, t.semester,
+                    r.instructor_rating, r.difficulty_rating, r.comment
+            FROM review r
+            INNER JOIN teaching t ON t.id = r.teaching_id
+            INNER JOIN instructor i ON t.instructor_id = i.id
+            INNER JOIN course c ON t.course_id = c.id;""")
+        cur.execute("ALTER TABLE review ENABLE TRIGGER USER;")
+        timings['review_feed'] = time.perf_counter() - start
+        conn.commit()
+
+        # ANALYZE can't run inside the transaction block psycopg2 opens
+        start = time.perf_counter()
+        conn.autocommit = True
+        try:
+            cur.execute("ANALYZE;")
+        finally:
+            conn.autocommit = False
+        timings['analyze'] = time.perf_counter() - start
+
+    return {"scale": scale, "seconds": timings}
+
+
+def _endpoints(scale: dict):
+    # name -> make_request(session, base_url, i) against the seeded data;
+    # every request is valid, so anything but 2xx is worth a look
+    instructors, courses, teachings = scale['instructors'], scale['courses'], scale['teachings']
+    users, reviews = scale['users'], scale['reviews']
+    subjects = course.SUBJECTS
+    rng = random.Random(0)
+    # seeding gave user u the teachings (j + u * 37) % teachings for
+    # j < ceil(reviews / users); posts continue from there, so each one is
+    # a new (user, teaching) pair
+    posted = itertools.count()
+    first = -(-reviews // users)
+
+    def course_no(i):
+        return str(1000 + i // len(subjects))
+
+    def post_review(session, base_url, i):
+        k = next(posted)
+        user = k % users
+        teaching = (first + k // users + user * 37) % teachings
+        return session.post(base_url + '/review',
+                            headers={'Authorization': f'Bearer {_token(user)}'},
+                            json={'teaching_id': teaching + 1,
+                                  'instructor_rating': 1 + k % 5,
+                                  'difficulty_rating': 1 + k % 3})
+
+    return {
+        'instructor': lambda s, b, i: s.get(
+            f'{b}/instructor?email=instructor{rng.randrange(instructors)}@uga.edu'),
+        'instructor_search': lambda s, b, i: s.get(
+            f'{b}/instructor?q=Last{rng.randrange(instructors)}'),
+        'course': lambda s, b, i: s.get(
+            f'{b}/course?subject={subjects[i % courses % len(subjects)]}&course_no={course_no(i % courses)}'),
+        'course_search': lambda s, b, i: s.get(
+            f'{b}/course?q=Synthetic Course {rng.randrange(courses)}'),
+        'teaching': lambda s, b, i: s.get(
+            f'{b}/teaching?course_id={1 + rng.randrange(courses)}'),
+        'teaching_page': lambda s, b, i: s.get(
+            f'{b}/teaching?after={rng.randrange(teachings)}&limit=100'),
+        'review': lambda s, b, i: s.get(
+            f'{b}/review?instructor_id={1 + rng.randrange(instructors)}'),
+        'review_page': lambda s, b, i: s.get(
+            f'{b}/review?after={rng.randrange(max(reviews, 1))}&limit=100'),
+        'review_post': post_review,
+        'token': lambda s, b, i: s.post(
+            f'{b}/token', json={'username': f'user{rng.randrange(users)}',
+                                'password': SEED_PASSWORD}),
+    }
+
+
+def _token(user: int) -> str:
+    # md5('token' || i), as seeded
+    return hashlib.md5(f'token{user}'.encode('utf-8')).hexdigest()
+
+
+def bench_endpoints(base_url: str, scale: dict, names=None, concurrency: int = 16,
+                    duration: float = 10) -> dict:
+    _check_scale(scale)
+    endpoints = _endpoints(scale)
+    return {name: _drive(base_url, endpoints[name], concurrency, duration)
+            for name in names or endpoints}
+
+
+# Synthetic SIS section listings, for the parse, scrape and ingest benchmarks
+# when there are no saved pages to hand; the markup follows the real pages
+# as far as course.py reads them. Each page is derived from its subject's
+# index alone.
+PAGE_HEAD = """\
+<!DOCTYPE html PUBLIC "-//W3C//DTD HTML 4.01 Transitional//EN" "http://www.w3.org/TR/html4/loose.dtd">
+<html lang="en"><head><title>Class Schedule Listing</title></head><body>
+<div class="pagetitlediv"><h2>Class Schedule Listing</h2></div>
+<div class="pagebodydiv">
+<table class="datadisplaytable" summary="This layout table is used to present the sections found" width="100%">
+<caption class="captiontext">Sections Found</caption>
+"""
+PAGE_SECTION = """\
+<tr>
+<th class="ddtitle" scope="colgroup"><a
+href="/PROD/bwckschd.p_disp_detail_sched?term_in={term}&amp;crn_in={crn}">{title} - {crn} - {subject} {course_no} - \
+{section:03d}</a></th>
+</tr>
+<tr>
+<td class="dddefault">
+<span class="fieldlabeltext">Associated Term: </span>Fall {year}
+<br>
+<span class="fieldlabeltext">Levels: </span>Undergraduate
+<br>
+<table class="datadisplaytable"
+summary="This table lists the scheduled meeting times and assigned instructors for this class..">
+<caption class="captiontext">Scheduled Meeting Times</caption>
+<tr>
+<th class="ddheader" scope="col">Type</th><th class="ddheader" scope="col">Time</th>
+<th class="ddheader" scope="col">Days</th>
+<th class="ddheader" scope="col">Where</th><th class="ddheader" scope="col">Instructors</th>
+</tr>
+<tr>
+<td class="dddefault">Class</td><td class="dddefault">{time}</td><td class="dddefault">{days}</td>
+<td class="dddefault">Boyd Research and Education Center {room:04d}</td>
+<td class="dddefault">{instructors}</td>
+</tr>
+</table>
+<br>
+</td>
+</tr>
+"""
+PAGE_INSTRUCTOR = """\
+{name} (<abbr title="Primary">P</abbr>)<a href="mailto:{email}" target="{name}"><img
+src="/wtlgifs/web_email.gif" alt="E-mail" /></a>"""
+PAGE_TAIL = """\
+</table>
+</div></body></html>
+"""
+TITLE_WORDS = ['Introduction', 'Advanced', 'Systems', 'Theory', 'Methods', 'Analysis', 'Design',
+               'Data', 'Software', 'Networks', 'History', 'Culture', 'Research', 'Practice']
+
+
+def fixture_page(index: int, sections: int = 200, year: str = '2021') -> str:
+    subject = course.SUBJECTS[index % len(course.SUBJECTS)]
+    rng = random.Random(index)
+    courses = max(1, sections // 3)
+    names = [(rng.choice(FIRST_NAMES), rng.choice(['', 'A.', 'Lee', 'M.']), f'Last{index}x{i}')
+             for i in range(max(1, sections // 4))]
+
+    parts = [PAGE_HEAD]
+    for section in range(sections):
+        n = rng.randrange(courses)
+        taught_by = rng.sample(names, 1 + (rng.random() < 0.1))
+        instructors = ', '.join(PAGE_INSTRUCTOR.format(
+            name=html.escape(' '.join(part for part in (first, middle, last) if part)),
+            email=f'{first.lower()}.{last.lower()}@uga.edu') for first, middle, last in taught_by)
+        parts.append(PAGE_SECTION.format(
+            term=f'{year}08', crn=10000 + index * 1000 + section % 1000, year=year,
+            title=html.escape(f'{TITLE_WORDS[n % len(TITLE_WORDS)]} & {TITLE_WORDS[n * 7 % len(TITLE_WORDS)]} {n}'),
+            subject=subject, course_no=1000 + n * 10, section=section % 1000,
+            time=f'{8 + section % 10:02d}:00 am - {8 + section % 10:02d}:50 am',
+            days=rng.choice(['MWF', 'TR', 'M', 'W']), room=rng.randrange(1, 400),
+            instructors=instructors))
+    parts.append(PAGE_TAIL)
+    return ''.join(parts)
+
+
+def write_fixtures(directory: str, subjects: int = 20, sections: int = 200) -> dict:
+    os.makedirs(directory, exist_ok=True)
+    paths, size, parsed = [], 0, 0
+    for index in range(subjects):
+        page = fixture_page(index, sections)
+        path = os.path.join(directory, f'{course.SUBJECTS[index % len(course.SUBJECTS)]}-{index}.html')
+        with open(path, 'w') as file:
+            file.write(page)
+        paths.append(path)
+        size += len(page)
+        parsed += len(course.parse_sections(page))
+    return {"paths": paths, "bytes": size, "sections": parsed}
+
+
+class _FixtureServer(ThreadingHTTPServer):
+    # stands in for SIS: answers every POST with the next saved page
+    daemon_threads = True
+
+    def __init__(self, pages) -> None:
+        super().__init__(('127.0.0.1', 0), _FixtureHandler)
+        self.pages = itertools.cycle(pages)
+        self.lock = threading.Lock()
+
+
+class _FixtureHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with self.server.lock:
+            page = next(self.server.pages)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(page)))
+        self.end_headers()
+        self.wfile.write(page)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def bench_scrape(paths, subjects: int = 100, max_workers: int = course.MAX_WORKERS) -> dict:
+    pages = []
+    for path in paths:
+        with open(path, 'rb') as file:
+            pages.append(file.read())
+
+    server = _FixtureServer(pages)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    sis_url = course.SIS_URL
+    course.SIS_URL = f'http://127.0.0.1:{server.server_port}/'
+    try:
+        # as many terms as it takes to issue `subjects` distinct requests
+        names = course.SUBJECTS[:subjects]
+        terms = [(str(2000 + i), FALL) for i in range(-(-subjects // len(names)))]
+        start = time.perf_counter()
+        by_term = course.scrape_term_subjects(terms, names, max_workers)
+        elapsed = time.perf_counter() - start
+    finally:
+        course.SIS_URL = sis_url
+        server.shutdown()
+        server.server_close()
+
+    issued = len(terms) * len(names)
+    sections = sum(len(s) for by_subject in by_term.values() for s in by_subject.values())
+    return {
+        "requests": issued,
+        "max_workers": max_workers,
+        "parser": course.PARSER,
+        "sections": sections,
+        "seconds": elapsed,
+        "requests_per_second": issued / elapsed
+    }
+
+
+def bench_ingest(dsn: str, paths, year: str = '1999', semester_enum: str = 'F') -> dict:
+    from ingest import changed_subjects, ingest_sections
+
+    by_subject = defaultdict(set)
+    for path in paths:
+        with open(path, 'r') as file:
+            for section in course.parse_sections(file.read()):
+                by_subject[section[0].strip()].add(section)
+
+    results = dict()
+    with _connection(_check_dsn(dsn)) as conn:
+        try:
+            # a fresh load, then the same listing again, which the
+            # fingerprints should reduce to nothing
+            for run in ('initial', 'unchanged'):
+                start = time.perf_counter()
+                changed = changed_subjects(conn, year, semester_enum, by_subject)
+                report = ingest_sections(conn, year, semester_enum, changed) if changed else None
+                results[run] = {
+                    "subjects": len(changed),
+                    "seconds": time.perf_counter() - start,
+                    "report": report
+                }
+        finally:
+            # ingest_sections leaves the commit to its caller, so this undoes
+            # everything it did, the course and instructor updates included
+            conn.rollback()
+
+    results['sections'] = sum(len(sections) for sections in by_subject.values())
+    return results
+
+
+CATALOG_CASES = {
+    'course_exact': ('course', {'subject': 'CSCI', 'course_no': '1302'}),
+    'course_subject': ('course', {'subject': 'csci'}),
+    'course_prefix': ('course', {'subject': 'CSCI', 'course_no': '4%'}),
+    'instructor_email': ('instructor', {'email': 'instructor1@uga.edu'}),
+    'instructor_prefix': ('instructor', {'last_name': 'Last1%'}),
+    'instructor_mixed': ('instructor', {'first_name': 'James', 'last_name': '%1'}),
+}
+
+
+def _run_handler(handler, conn):
+    try:
+        query = next(handler)
+        while True:
+            with conn.cursor() as cur:
+                cur.execute(query.sql, query.params)
+                query = handler.send(cur.fetchall())
+    except StopIteration as e:
+        return e.value
+
+
+def bench_catalog(dsn: str, number: int = 200) -> dict:
+    # the in-memory catalog against the SQL it replaces, on the seeded
+    # benchmark database
+    import handlers
+    from catalog import Catalog
+    from versions import DataVersions
+    from werkzeug.datastructures import MultiDict
+
+    _check_dsn(dsn)
+    connection = functools.partial(_connection, dsn)
+    catalog = Catalog(connection, DataVersions(connection, float('inf')), float('inf'))
+    start = time.perf_counter()
+    catalog.load()
+    load_seconds = time.perf_counter() - start
+
+    results = dict()
+    with connection() as conn:
+        for name, (table, args) in CATALOG_CASES.items():
+            args = MultiDict(args)
+            find = handlers.find_course if table == 'course' else handlers.find_instructor
+            sql = _run_handler(find(args), conn)
+            memory = _run_handler(find(args, catalog), conn)
+            timings = {
+                'sql': timeit.timeit(lambda: _run_handler(find(args), conn), number=number) / number,
+                'catalog': timeit.timeit(lambda: _run_handler(find(args, catalog), conn),
+                                         number=number) / number
+            }
+            results[name] = {
+                "identical": sql == memory,
+                "seconds": timings,
+                "speedup": timings['sql'] / timings['catalog']
+            }
+
+    return {"load_seconds": load_seconds, **catalog.stats(), "lookups": results}
+
+
+SNAPSHOT_CASES = {
+    'first_page': {'limit': '100'},
+    'deep_page': {'limit': '100', 'after': '25000'},
+    'full_page': {'limit': '1000'},
+    'ndjson': {'format': 'ndjson'},
+}
+
+
+def _sql_ndjson(handler, conn) -> bytes:
+    # the body a Stream sends, all at once
+    stream = _run_handler(handler, conn)
+    with conn.cursor() as cur:
+        cur.execute(stream.sql, stream.params)
+        return b''.join(serialize.dumps(stream.to_json(row)) for row in cur)
+
+
+def bench_snapshot(dsn: str, year: str = '2021', semester_enum: str = 'F',
+                   number: int = 200) -> dict:
+    # one term's /teaching pages from its snapshot file against the SQL they
+    # replace, on the seeded benchmark database
+    import handlers
+    from snapshot import Snapshots
+    from versions import DataVersions
+    from werkzeug.datastructures import MultiDict
+
+    _check_dsn(dsn)
+    data_versions = DataVersions(functools.partial(_connection, dsn), float('inf'))
+    results = dict()
+    with tempfile.TemporaryDirectory() as directory, _connection(dsn) as conn:
+        # the snapshot is keyed on the term's version, which seeding resets
+        data_versions.bump(conn, [f'catalog:{year}{semester_enum}'])
+        data_versions.refresh()
+        snapshots = Snapshots(directory, data_versions)
+        start = time.perf_counter()
+        path = snapshots.write(conn, year, semester_enum)
+        write_seconds = time.perf_counter() - start
+        sizes = {"ndjson_bytes": os.path.getsize(path),
+                 "gzip_bytes": os.path.getsize(path + '.gz')}
+
+        for name, args in SNAPSHOT_CASES.items():
+            args = MultiDict({'year': year, 'semester': semester_enum, **args})
+            sql_run = _sql_ndjson if name == 'ndjson' else _run_handler
+            sql = sql_run(handlers.find_teaching(args), conn)
+            snapshot = _run_handler(handlers.find_teaching(args, snapshots), conn)
+            timings = {
+                'sql': timeit.timeit(lambda: sql_run(handlers.find_teaching(args), conn),
+                                     number=number) / number,
+                'snapshot': timeit.timeit(
+                    lambda: _run_handler(handlers.find_teaching(args, snapshots), conn),
+                    number=number) / number
+            }
+            results[name] = {
+                "identical": sql == (b''.join(snapshot[0]) if name == 'ndjson' else snapshot),
+                "seconds": timings,
+                "speedup": timings['sql'] / timings['snapshot']
+            }
+
+    return {"write_seconds": write_seconds, **sizes, "pages": results}
+
+
+# runs in a fresh interpreter, from outside the repository
+COLD_START = """\
+import json, sys, time
+start = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+import app
+imported = time.perf_counter()
+response = app.app.test_client().get(sys.argv[2])
+answered = time.perf_counter()
+print(json.dumps({
+    "import_seconds": imported - start,
+    "first_request_seconds": answered - imported,
+    "status": response.status_code,
+    "scraper_loaded": any(m in sys.modules for m in ('course', 'bs4', 'requests'))
+}))
+"""
+
+
+def bench_cold_start(path: str = '/course?subject=CSCI', number: int = 5) -> dict:
+    # import + first request, as a freshly forked worker would pay it
+    runs = []
+    for _ in range(number):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, '-c', COLD_START, REPO, path],
+                                cwd=tempfile.gettempdir(), capture_output=True,
+                                text=True, check=True).stdout
+        run = json.loads(output)
+        run['process_seconds'] = time.perf_counter() - start
+        runs.append(run)
+
+    return {
+        "path": path,
+        "runs": runs,
+        **{f'{key}_p50': _percentile([run[key] for run in runs], 0.50)
+           for key in ('import_seconds', 'first_request_seconds', 'process_seconds')}
+    }
+
+
+def _add_scale_args(parser):
+    parser.add_argument('--instructors', type=int, default=2_000)
+    parser.add_argument('--courses', type=int, default=4_000)
+    parser.add_argument('--teachings', type=int, default=50_000)
+    parser.add_argument('--users', type=int, default=20_000)
+    parser.add_argument('--reviews', type=int, default=1_000_000)
+
+
+def _scale(args) -> dict:
+    return {name: getattr(args, name)
+            for name in ('instructors', 'courses', 'teachings', 'users', 'reviews')}
+
+
+if __name__ == '__main__':
+    # every benchmark can also write its JSON to --output for later comparison
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--output', default=None, help='also write the results to this file')
+
+    # the benchmarks that use a database need their own, never the app's
+    bench_database = argparse.ArgumentParser(add_help=False)
+    bench_database.add_argument('--dsn', default=os.environ.get('bench_dsn', ''),
+                                help='benchmark database (default: bench_dsn)')
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    # e.g. fixtures /tmp/sis, then parse /tmp/sis/*.html
+    fixtures_parser = subparsers.add_parser('fixtures', parents=[common],
+                                            help='write synthetic section listing pages')
+    fixtures_parser.add_argument('directory')
+    fixtures_parser.add_argument('--subjects', type=int, default=20)
+    fixtures_parser.add_argument('--sections', type=int, default=200)
+
+    parse_parser = subparsers.add_parser('parse', parents=[common])
+    parse_parser.add_argument('fixtures', nargs='+', help='saved or generated section listing pages')
+    parse_parser.add_argument('--number', type=int, default=5)
+
+    serialize_parser = subparsers.add_parser('serialize', parents=[common])
+    serialize_parser.add_argument('--rows', type=int, default=10_000)
+    serialize_parser.add_argument('--number', type=int, default=5)
+
+    # e.g. load --target wsgi=http://127.0.0.1:4370 --target asgi=http://127.0.0.1:4371
+    load_parser = subparsers.add_parser('load', parents=[common])
+    load_parser.add_argument('--target', action='append', required=True,
+                             help='name=base_url of a running server')
+    load_parser.add_argument('--path', action='append',
+                             default=None, help='request path, may be repeated')
+    load_parser.add_argument('--concurrency', type=int, default=16)
+    load_parser.add_argument('--duration', type=float, default=10)
+
+    seed_parser = subparsers.add_parser('seed', parents=[common, bench_database],
+                                        help='load synthetic data into the benchmark database')
+    seed_parser.add_argument('--force', action='store_true',
+                             help='replace whatever data the database already has')
+    _add_scale_args(seed_parser)
+
+    # e.g. endpoints http://127.0.0.1:4370 with the scale the database was seeded at
+    endpoints_parser = subparsers.add_parser('endpoints', parents=[common])
+    endpoints_parser.add_argument('base_url')
+    endpoints_parser.add_argument('--endpoint', action='append', default=None,
+                                  help='endpoint name, may be repeated (default: all)')
+    endpoints_parser.add_argument('--concurrency', type=int, default=16)
+    endpoints_parser.add_argument('--duration', type=float, default=10)
+    _add_scale_args(endpoints_parser)
+
+    scrape_parser = subparsers.add_parser('scrape', parents=[common])
+    scrape_parser.add_argument('fixtures', nargs='+', help='saved or generated section listing pages')
+    scrape_parser.add_argument('--subjects', type=int, default=100)
+    scrape_parser.add_argument('--workers', type=int, default=course.MAX_WORKERS)
+
+    ingest_parser = subparsers.add_parser('ingest', parents=[common, bench_database])
+    ingest_parser.add_argument('fixtures', nargs='+', help='saved or generated section listing pages')
+    ingest_parser.add_argument('--year', default='1999', help='scratch term, rolled back afterwards')
+
+    catalog_parser = subparsers.add_parser('catalog', parents=[common, bench_database])
+    catalog_parser.add_argument('--number', type=int, default=200)
+
+    snapshot_parser = subparsers.add_parser('snapshot', parents=[common, bench_database])
+    snapshot_parser.add_argument('--year', default='2021')
+    snapshot_parser.add_argument('--semester', default='F', help='S, X or F')
+    snapshot_parser.add_argument('--number', type=int, default=200)
+
+    cold_start_parser = subparsers.add_parser('cold-start', parents=[common])
+    cold_start_parser.add_argument('--path', default='/course?subject=CSCI')
+    cold_start_parser.add_argument('--number', type=int, default=5)
+
+    args = parser.parse_args()
+    if args.benchmark == 'fixtures':
+        result = write_fixtures(args.directory, args.subjects, args.sections)
+    elif args.benchmark == 'parse':
+        result = bench_parse(args.fixtures, args.number)
+    elif args.benchmark == 'serialize':
+        result = bench_serialize(args.rows, args.number)
+    elif args.benchmark == 'seed':
+        result = bench_seed(args.dsn, _scale(args), args.force)
+    elif args.benchmark == 'endpoints':
+        result = bench_endpoints(args.base_url.rstrip('/'), _scale(args), args.endpoint,
+                                 args.concurrency, args.duration)
+    elif args.benchmark == 'scrape':
+        result = bench_scrape(args.fixtures, args.subjects, args.workers)
+    elif args.benchmark == 'ingest':
+        result = bench_ingest(args.dsn, args.fixtures, args.year)
+    elif args.benchmark == 'catalog':
+        result = bench_catalog(args.dsn, args.number)
+    elif args.benchmark == 'snapshot':
+        result = bench_snapshot(args.dsn, args.year, args.semester, args.number)
+    elif args.benchmark == 'cold-start':
+        result = bench_cold_start(args.path, args.number)
+    else:
+        targets = dict(target.split('=', 1) for target in args.target)
+        paths = args.path or ['/course?subject=CSCI', '/instructor?q=smith',
+                              '/teaching?semester=fall', '/review?limit=100']
+        result = bench_load(targets, paths, args.concurrency, args.duration)
+
+    result = {"benchmark": args.benchmark, "time": time.time(), "results": result}
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(result, file, indent=2)
+    json.dump(result, sys.stdout, indent=2)
+    print()
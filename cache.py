@@ -0,0 +1,158 @@
+import importlib
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from functools import wraps
+
+from dotenv import load_dotenv
+from flask import g, request
+
+load_dotenv()
+
+cache_size = int(os.environ.get('cache_size', 1024))
+cache_ttl = float(os.environ.get('cache_ttl', 300))
+cache_backend = os.environ.get('cache_backend', 'cache:LocalBackend')
+
+GENERATION_TTL = 24 * 3600
+
+
+class Backend:
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl: float):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class LocalBackend(Backend):
+    def __init__(self, maxsize: int) -> None:
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl: float):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ResponseCache:
+    def __init__(self, backend: Backend, ttl: float) -> None:
+        self.backend = backend
+        self.ttl = ttl
+        self.enabled = ttl > 0
+
+        self._hits = dict()
+        self._misses = dict()
+        self._lock = threading.Lock()
+
+    # Replacing a namespace's generation orphans its entries, which then age
+    # out of the LRU instead of being scanned for and deleted. Generations
+    # are kept in the backend, so with a shared one an invalidation reaches
+    # every worker; they're random rather than counted so concurrent bumps
+    # can't collapse into one.
+    def generation(self, namespace):
+        key = ('generation', namespace)
+        generation = self.backend.get(key)
+        if generation is None:
+            # a lost generation must not bring back entries cached under an
+            # earlier one, so a new one is started
+            generation = uuid.uuid4().hex
+            self.backend.set(key, generation, GENERATION_TTL)
+        return generation
+
+    def invalidate(self, *namespaces):
+        for namespace in namespaces:
+            self.backend.set(('generation', namespace), uuid.uuid4().hex, GENERATION_TTL)
+
+    def _count(self, counter, namespace):
+        with self._lock:
+            counter[namespace] = counter.get(namespace, 0) + 1
+
+    def key(self, namespace, path: str, args, version) -> tuple:
+        return (namespace, self.generation(namespace), version, path,
+                tuple(sorted(args.items(multi=True))))
+
+    def lookup(self, namespace, key):
+        value = self.backend.get(key)
+        self._count(self._misses if value is None else self._hits, namespace)
+        return value
+
+    def store(self, key, value):
+        # only plain response values; a streamed Response isn't cacheable
+        if isinstance(value, (dict, tuple)):
+            self.backend.set(key, value, self.ttl)
+
+    def cached(self, namespace):
+        def decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                if not self.enabled or request.args.get('format') == 'ndjson' \
+                        or g.get('read_primary'):
+                    return f(*args, **kwargs)
+
+                # the data version is set by versions.conditional, when it
+                # wraps the view
+                key = self.key(namespace, request.path, request.args, g.get('data_version'))
+                value = self.lookup(namespace, key)
+                if value is None:
+                    value = f(*args, **kwargs)
+                    self.store(key, value)
+                return value
+            return wrapper
+        return decorator
+
+    def stats(self):
+        with self._lock:
+            namespaces = set(self._hits) | set(self._misses)
+            return {
+                namespace: {
+                    "hits": self._hits.get(namespace, 0),
+                    "misses": self._misses.get(namespace, 0)
+                }
+                for namespace in sorted(namespaces)
+            }
+
+
+def _load_backend(path: str) -> Backend:
+    module_name, class_name = path.split(':')
+    backend_class = getattr(importlib.import_module(module_name), class_name)
+    return backend_class(cache_size)
+
+
+response_cache = ResponseCache(_load_backend(cache_backend), cache_ttl)
@@ -0,0 +1,209 @@
+import logging
+import re
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from versions import DataVersions
+
+# In-process copy of the course and instructor tables. /course and
+# /instructor filters are ILIKE patterns; literal ones are answered from a
+# per-column exact index and 'prefix%' ones from a sorted index. Other
+# filters are checked row by row on what those indexes return.
+
+COURSE_COLUMNS = ('id', 'subject', 'course_no', 'title')
+INSTRUCTOR_COLUMNS = ('id', 'email', 'first_name', 'middle_name', 'last_name')
+WILDCARDS = re.compile(r'[%_\\]')
+
+
+def _like_regex(pattern: str):
+    # ILIKE semantics: % and _ are wildcards, backslash escapes
+    parts, i = [], 0
+    while i < len(pattern):
+        ch = pattern[i]
+        if ch == '\\' and i + 1 < len(pattern):
+            parts.append(re.escape(pattern[i + 1]))
+            i += 2
+            continue
+        parts.append('.*' if ch == '%' else '.' if ch == '_' else re.escape(ch))
+        i += 1
+    return re.compile(''.join(parts), re.IGNORECASE | re.DOTALL)
+
+
+class Table:
+    __slots__ = ('columns', 'rows', 'exact', 'keys', 'positions')
+
+    def __init__(self, columns: Sequence[str], rows: List[tuple], indexed: Sequence[str]) -> None:
+        self.columns = tuple(columns)
+        self.rows = sorted(rows)
+        # column -> lowered value -> row positions
+        self.exact = dict()
+        # column -> sorted lowered values, and the row position of each
+        self.keys = dict()
+        self.positions = dict()
+
+        for column in indexed:
+            c = self.columns.index(column)
+            exact = dict()
+            entries = []
+            for position, row in enumerate(self.rows):
+                if row[c] is None:
+                    continue
+                key = row[c].lower()
+                exact.setdefault(key, array('I')).append(position)
+                entries.append((key, position))
+            entries.sort()
+            self.exact[column] = exact
+            self.keys[column] = [key for key, _ in entries]
+            self.positions[column] = array('I', (position for _, position in entries))
+
+    def _candidates(self, column: str, pattern: str):
+        # row positions that may match, or None if the column must be scanned
+        if not WILDCARDS.search(pattern):
+            return self.exact[column].get(pattern.lower(), ())
+        prefix = pattern[:-1]
+        if pattern.endswith('%') and prefix and not WILDCARDS.search(prefix):
+            prefix = prefix.lower()
+            keys = self.keys[column]
+            start = end = bisect_left(keys, prefix)
+            while end < len(keys) and keys[end].startswith(prefix):
+                end += 1
+            return self.positions[column][start:end]
+        return None
+
+    def select(self, filters: Sequence[Tuple[str, str]]) -> Optional[List[tuple]]:
+        # None when no filter can use an index; Postgres' trigram indexes
+        # beat a Python scan for those
+        candidates, used = None, None
+        for column, pattern in filters:
+            positions = self._candidates(column, pattern)
+            if positions is not None and (candidates is None or len(positions) < len(candidates)):
+                candidates, used = positions, (column, pattern)
+        if candidates is None and filters:
+            return None
+        positions = range(len(self.rows)) if candidates is None else sorted(candidates)
+
+        # the filter the candidates came from holds for all of them
+        matchers = [(self.columns.index(column), _matcher(pattern))
+                    for column, pattern in filters if (column, pattern) != used]
+        rows = self.rows
+        if not matchers:
+            return [rows[position] for position in positions]
+        return [rows[position] for position in positions
+                if all(rows[position][c] is not None and match(rows[position][c])
+                       for c, match in matchers)]
+
+
+def _matcher(pattern: str) -> Callable[[str], bool]:
+    if not WILDCARDS.search(pattern):
+        pattern = pattern.lower()
+        return lambda value: value.lower() == pattern
+    return _like_regex(pattern).fullmatch
+
+
+class Snapshot:
+    __slots__ = ('version', 'courses', 'instructors', 'loaded')
+
+    def __init__(self, version: int, courses: Table, instructors: Table) -> None:
+        self.version = version
+        self.courses = courses
+        self.instructors = instructors
+        self.loaded = time.time()
+
+    def footprint(self) -> int:
+        return _deep_sizeof((self.courses, self.instructors), set())
+
+
+def _deep_sizeof(obj, seen: set) -> int:
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_deep_sizeof(k, seen) + _deep_sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(_deep_sizeof(item, seen) for item in obj)
+    elif hasattr(obj, '__slots__'):
+        size += sum(_deep_sizeof(getattr(obj, name), seen) for name in obj.__slots__)
+    return size
+
+
+class Catalog:
+    # Loaded on first use in each process. Every check_interval seconds a
+    # background thread compares the 'catalog' data version and, if a term
+    # update bumped it, builds a new snapshot and swaps it in; requests keep
+    # reading the old one meanwhile.
+    def __init__(self, connect: Callable, versions: DataVersions, check_interval: float) -> None:
+        self.connect = connect
+        self.versions = versions
+        self.check_interval = check_interval
+
+        self._snapshot = None
+        self._checked = 0
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def load(self) -> Snapshot:
+        version, = self.versions.get(('catalog',))
+        with self.connect() as conn, conn.cursor() as cur:
+            cur.execute("SELECT id, subject, course_no, title FROM course;")
+            courses = [(i, sys.intern(subject), course_no, title)
+                       for i, subject, course_no, title in cur.fetchall()]
+            cur.execute("SELECT id, email, first_name, middle_name, last_name FROM instructor;")
+            instructors = cur.fetchall()
+
+        snapshot = Snapshot(version,
+                            Table(COURSE_COLUMNS, courses, ('subject', 'course_no')),
+                            Table(INSTRUCTOR_COLUMNS, instructors,
+                                  ('email', 'first_name', 'middle_name', 'last_name')))
+        self._snapshot = snapshot
+        self._checked = time.monotonic()
+        return snapshot
+
+    def _refresh(self):
+        try:
+            version, = self.versions.get(('catalog',))
+            if version != self._snapshot.version:
+                self.load()
+                logging.info('catalog version=%s reloaded', version)
+            self._checked = time.monotonic()
+        except Exception:
+            logging.exception('catalog reload failed')
+        finally:
+            self._refreshing = False
+
+    def snapshot(self) -> Snapshot:
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                return self._snapshot or self.load()
+
+        if time.monotonic() - self._checked > self.check_interval and not self._refreshing:
+            with self._lock:
+                if not self._refreshing:
+                    self._refreshing = True
+                    threading.Thread(target=self._refresh, daemon=True).start()
+        return snapshot
+
+    @property
+    def ready(self) -> bool:
+        # whether snapshot() can answer without loading
+        return self._snapshot is not None
+
+    def expire(self):
+        self._checked = 0
+
+    def stats(self) -> Optional[Dict[str, object]]:
+        snapshot = self._snapshot
+        if snapshot is None:
+            return None
+        return {
+            "version": snapshot.version,
+            "loaded": snapshot.loaded,
+            "courses": len(snapshot.courses.rows),
+            "instructors": len(snapshot.instructors.rows),
+            "bytes": snapshot.footprint()
+        }
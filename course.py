@@ -1,40 +1,108 @@
 import logging
+import os
 import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from html.parser import HTMLParser
+from typing import Dict, Iterable, Iterator, Optional, Tuple
 
 import requests
 from bs4 import BeautifulSoup
 from bs4.element import Tag
+from dotenv import load_dotenv
 
-from exception import InvalidTerm
+import metrics
+from exception import InvalidTerm, ScrapeError
 from semester import Semester
 
-logging.basicConfig(filename='debug.log', level=logging.DEBUG)
+load_dotenv()
+
+# DEBUG logs every request and unparsed name; below it the calls cost nothing
+log_level = os.environ.get('log_level', 'WARNING').upper()
 
 COURSE_TITLE_REGEX = r"(?P<t>\A.+) - \d{5} - (?P<s>[A-Z]{2,4}) (?P<c>[0-9A-Z]{4,5})"
 NAME_REGEX = r"(?P<first>[^ ]+) (?P<middle>.+) (?P<last>[^ ]+)"
 NAME_NO_MIDDLE_REGEX = r"(?P<first>[^ ]+) (?P<last>[^ ]+)"
 
-with open('raw_data', 'r') as file:
-    RAW_DATA = file.read()
+# the whole text SIS answers with for a term it doesn't know
+INVALID_TERM = 'Not a valid term'
+
+COURSE_TITLE_PATTERN = re.compile(COURSE_TITLE_REGEX)
+NAME_PATTERN = re.compile(NAME_REGEX)
+NAME_NO_MIDDLE_PATTERN = re.compile(NAME_NO_MIDDLE_REGEX)
+
+SIS_URL = os.environ.get('sis_url', 'https://sis-ssb-prod.uga.edu/PROD/bwckschd.p_get_crse_unsec')
+MAX_WORKERS = int(os.environ.get('scrape_workers', 8))
+RETRIES = int(os.environ.get('scrape_retries', 3))
+BACKOFF = float(os.environ.get('scrape_backoff', 1))
+TIMEOUT = float(os.environ.get('scrape_timeout', 60))
+PARSER = os.environ.get('scrape_parser', 'stream')
+CHUNK_SIZE = 64 * 1024
+
+RAW_DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'raw_data')
+
+# the form template lists every subject; requests are split one subject each
+SUBJECT_REGEX = r"&sel_subj=(?!dummy)([A-Z]+)"
+
+
+@lru_cache(maxsize=None)
+def _form() -> Dict[str, object]:
+    # read on first use rather than at import, wherever the process started
+    with open(RAW_DATA_PATH, 'r') as file:
+        raw_data = file.read()
+    return {
+        'RAW_DATA': raw_data,
+        'SUBJECTS': tuple(re.findall(SUBJECT_REGEX, raw_data)),
+        'SUBJECT_DATA': re.sub(f"(?:{SUBJECT_REGEX})+", "&sel_subj={subject}", raw_data, count=1)
+    }
+
+
+def __getattr__(name: str):
+    # course.RAW_DATA, course.SUBJECTS and course.SUBJECT_DATA
+    if name in ('RAW_DATA', 'SUBJECTS', 'SUBJECT_DATA'):
+        return _form()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+_local = threading.local()
+
 
+def _session() -> requests.Session:
+    if not hasattr(_local, 'session'):
+        _local.session = requests.Session()
+    return _local.session
 
-def scrape_courses(year: str, semester: Semester) -> set:
-    data = RAW_DATA.format(year=year, semester=semester)
-    logging.debug(f"data = {data}")
-    response = requests.post('https://sis-ssb-prod.uga.edu/PROD/bwckschd.p_get_crse_unsec',
-                             data=data)
 
-    if response.status_code != 200:
-        _msg = f'{response.status_code} returned for {data}'
+def fetch(data: str) -> requests.Response:
+    for attempt in range(RETRIES + 1):
+        try:
+            response = _session().post(SIS_URL, data=data, timeout=TIMEOUT, stream=True)
+            if response.status_code == 200:
+                return response
+            response.close()
+            _msg = f'{response.status_code} returned for {data}'
+        except requests.RequestException as e:
+            _msg = f'{e} raised for {data}'
+
+        metrics.SCRAPE_FAILURES.inc()
         logging.warning(_msg)
-        return set()
+        if attempt < RETRIES:
+            time.sleep(BACKOFF * 2 ** attempt)
+
+    raise ScrapeError(_msg)
 
-    soup: BeautifulSoup = BeautifulSoup(response.text, 'html.parser')
-    if soup.find(text='Not a valid term') is not None:
+
+def parse_sections(html: str, year: str = '', semester: Semester = '') -> set:
+    soup: BeautifulSoup = BeautifulSoup(html, 'html.parser')
+    if soup.find(text=INVALID_TERM) is not None:
         raise InvalidTerm(f"{year}{semester} is not a valid term string")
 
     caption = soup.caption
-    assert isinstance(caption, Tag)
+    if caption is None:
+        # no sections were found for this request
+        return set()
 
     parent = caption.parent
     assert isinstance(parent, Tag)
@@ -52,7 +120,7 @@ def scrape_courses(year: str, semester: Semester) -> set:
 
         title_raw = a.text
 
-        match = re.search(COURSE_TITLE_REGEX, title_raw)
+        match = COURSE_TITLE_PATTERN.search(title_raw)
         if match is None:
             _msg = f'match is None\n{title_raw}'
             return courses
@@ -65,17 +133,10 @@ def scrape_courses(year: str, semester: Semester) -> set:
             instructor = mailto['target']
             assert isinstance(instructor, str)
 
-            first = middle = last = ""
-            match = re.search(NAME_REGEX, instructor)
-            if match:
-                first, middle, last = match.group('first', 'middle', 'last')
-            else:
-                match = re.search(NAME_NO_MIDDLE_REGEX, instructor)
-                if not match:
-                    _msg = f'Could not parse the fullname of: {instructor}'
-                    logging.debug(_msg)
-                    continue
-                first, last = match.group('first', 'last')
+            name = parse_instructor(instructor)
+            if name is None:
+                continue
+            first, middle, last = name
 
             email = mailto['href'][7:]  # remove 'mailto:'
             courses.add((subject, course_no, title,
@@ -83,19 +144,177 @@ def scrape_courses(year: str, semester: Semester) -> set:
     return courses
 
 
+def parse_instructor(name: str) -> Optional[Tuple[str, str, str]]:
+    match = NAME_PATTERN.search(name)
+    if match:
+        return match.group('first', 'middle', 'last')
+
+    match = NAME_NO_MIDDLE_PATTERN.search(name)
+    if not match:
+        logging.debug('unparsed instructor name=%r', name)
+        return None
+    first, last = match.group('first', 'last')
+    return first, "", last
+
+
+# incremental equivalent of parse_sections that only tracks the section
+# titles and the instructor mailto links
+class SectionParser(HTMLParser):
+    def __init__(self) -> None:
+        super().__init__(convert_charrefs=True)
+        self.sections = []
+        self.invalid_term = False
+        self.done = False
+
+        self._depth = 0
+        self._table_depth = None
+        self._in_title = False
+        self._title = None
+        self._course = None
+        # text since the last tag while it could still be INVALID_TERM;
+        # feed() hands text over in pieces when a chunk boundary splits it
+        self._data = ''
+
+    def pop(self) -> list:
+        sections, self.sections = self.sections, []
+        return sections
+
+    def close(self) -> None:
+        super().close()
+        if self._data == INVALID_TERM:
+            self.invalid_term = True
+
+    def handle_starttag(self, tag, attrs):
+        if self._data:
+            if self._data == INVALID_TERM:
+                self.invalid_term = True
+            self._data = ''
+        if tag == 'table':
+            self._depth += 1
+            return
+
+        if self.done:
+            return
+
+        if tag == 'caption' and self._table_depth is None:
+            self._table_depth = self._depth
+        elif self._table_depth is None:
+            return
+        elif tag == 'th':
+            self._in_title = 'ddtitle' in (dict(attrs).get('class') or '').split()
+        elif tag == 'a' and self._in_title:
+            self._title = []
+        elif tag == 'a' and self._course is not None:
+            attrs = dict(attrs)
+            href = attrs.get('href') or ''
+            if href.startswith('mailto:') and attrs.get('target') is not None:
+                name = parse_instructor(attrs['target'])
+                if name is not None:
+                    email = href[7:]  # remove 'mailto:'
+                    self.sections.append((*self._course, email, *name))
+
+    def handle_endtag(self, tag):
+        if self._data:
+            if self._data == INVALID_TERM:
+                self.invalid_term = True
+            self._data = ''
+        if tag == 'table':
+            if self._depth == self._table_depth:
+                self.done = True
+            self._depth -= 1
+        elif tag == 'th':
+            self._in_title = False
+        elif tag == 'a' and self._title is not None:
+            title_raw = ''.join(self._title)
+            self._title = None
+            match = COURSE_TITLE_PATTERN.search(title_raw)
+            if match is None:
+                self.done = True
+                return
+            self._course = match.group('s', 'c', 't')
+
+    def handle_data(self, data):
+        if self._title is not None:
+            self._title.append(data)
+        else:
+            data = self._data + data
+            # '\0' marks text that can't match any more
+            self._data = data if INVALID_TERM.startswith(data) else '\0'
+
+
+def iter_sections(chunks: Iterable[str], year: str = '', semester: Semester = '') -> Iterator[tuple]:
+    parser = SectionParser()
+    for chunk in chunks:
+        parser.feed(chunk)
+        if parser.invalid_term:
+            raise InvalidTerm(f"{year}{semester} is not a valid term string")
+        yield from parser.pop()
+        if parser.done:
+            return
+
+    parser.close()
+    if parser.invalid_term:
+        raise InvalidTerm(f"{year}{semester} is not a valid term string")
+    yield from parser.pop()
+
+
+def scrape_subject(year: str, semester: Semester, subject: str) -> set:
+    data = _form()['SUBJECT_DATA'].format(year=year, semester=semester, subject=subject)
+    logging.debug('scrape term=%s%s subject=%s data=%s', year, semester, subject, data)
+    with metrics.SCRAPE_SECONDS.time(), fetch(data) as response:
+        if PARSER == 'soup':
+            return parse_sections(response.text, year, semester)
+
+        response.encoding = response.encoding or 'utf-8'
+        chunks = response.iter_content(CHUNK_SIZE, decode_unicode=True)
+        return set(iter_sections(chunks, year, semester))
+
+
+def scrape_term_subjects(terms: Iterable[Tuple[str, Semester]], subjects: Iterable[str] = None,
+                         max_workers: int = MAX_WORKERS) -> Dict[Tuple[str, Semester], Dict[str, set]]:
+    terms = list(terms)
+    subjects = list(_form()['SUBJECTS'] if subjects is None else subjects)
+    results = {term: dict() for term in terms}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(scrape_subject, year, semester, subject): ((year, semester), subject)
+            for year, semester in terms
+            for subject in subjects
+        }
+        try:
+            for future in as_completed(futures):
+                term, subject = futures[future]
+                results[term][subject] = future.result()
+        except:
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+    return results
+
+
+def scrape_terms(terms: Iterable[Tuple[str, Semester]], subjects: Iterable[str] = None,
+                 max_workers: int = MAX_WORKERS) -> Dict[Tuple[str, Semester], set]:
+    return {
+        term: set().union(*by_subject.values())
+        for term, by_subject in scrape_term_subjects(terms, subjects, max_workers).items()
+    }
+
+
+def scrape_courses(year: str, semester: Semester, subjects: Iterable[str] = None,
+                   max_workers: int = MAX_WORKERS) -> set:
+    return scrape_terms([(year, semester)], subjects, max_workers)[(year, semester)]
+
+
 if __name__ == '__main__':
     from semester import FALL, SPRING, SUMMER
-    with open('2021SPRING', 'w') as file:
-        file.write('subject,,course_no,,title,,email,,first,,middle,,last')
-        for course in scrape_courses('2021', SPRING):
-            file.write('\n' + ',,'.join(course))
-
-    with open('2021SUMMER', 'w') as file:
-        file.write('subject,,course_no,,title,,email,,first,,middle,,last')
-        for course in scrape_courses('2021', SUMMER):
-            file.write('\n' + ',,'.join(course))
-
-    with open('2021FALL', 'w') as file:
-        file.write('subject,,course_no,,title,,email,,first,,middle,,last')
-        for course in scrape_courses('2021', FALL):
-            file.write('\n' + ',,'.join(course))
+
+    logging.basicConfig(filename='debug.log', level=log_level)
+    terms = {('2021', SPRING): '2021SPRING',
+             ('2021', SUMMER): '2021SUMMER',
+             ('2021', FALL): '2021FALL'}
+
+    for term, sections in scrape_terms(terms).items():
+        with open(terms[term], 'w') as file:
+            file.write('subject,,course_no,,title,,email,,first,,middle,,last')
+            for course in sections:
+                file.write('\n' + ',,'.join(course))
@@ -1,134 +1,230 @@
 import logging
 import os
 import uuid
-from typing import Optional
+from contextlib import nullcontext
+from typing import Callable, Optional
 
 import psycopg2 as pg
 from dotenv import load_dotenv
 
 import login
-from course import scrape_courses
+import metrics
+from cache import LocalBackend, response_cache
+from catalog import Catalog
+from exception import HashBusy
+from pool import ConnectionPool, ReplicaRouter
+from queries import PreparingConnection
 from semester import FALL, Semester
+from snapshot import Snapshots
+from versions import DataVersions
 
 load_dotenv()
 
 dbname = os.environ.get('db_name')
 host = os.environ.get('db_host')
+port = os.environ.get('db_port')
 user = os.environ.get('db_user')
 password = os.environ.get('db_password')
 
+# read replicas of the same database, e.g. db_replicas=replica1,replica2:5433
+replicas = [replica.strip() for replica in os.environ.get('db_replicas', '').split(',')
+            if replica.strip()]
+replica_retry = float(os.environ.get('db_replica_retry', 30))
+# seconds a user's reads stay on primary after they post
+read_your_writes = float(os.environ.get('read_your_writes', 5))
+# signs the read-your-writes cookie; without one a pin only holds in the
+# process that took the post
+secret_key = os.environ.get('secret_key', '')
 
-def _connectdb():
-    return pg.connect(dbname=dbname, host=host,
-                      user=user, password=password)
+pool_min = int(os.environ.get('db_pool_min', 1))
+pool_max = int(os.environ.get('db_pool_max', 10))
+pool_timeout = float(os.environ.get('db_pool_timeout', 5))
+connect_timeout = int(os.environ.get('db_connect_timeout', 5))
+# idle connections older than this many seconds are pinged before reuse
+pool_check_idle = float(os.environ.get('db_pool_check_idle', 30))
 
+token_cache_size = int(os.environ.get('token_cache_size', 10_000))
+token_cache_ttl = float(os.environ.get('token_cache_ttl', 600))
 
-# Database connection
-conn = _connectdb()
+version_ttl = float(os.environ.get('version_ttl', 5))
 
+# answer /course and /instructor from an in-process copy of both tables
+in_memory_catalog = bool(int(os.environ.get('in_memory_catalog', 0)))
+# where update() writes per-term teaching snapshots and /teaching serves
+# them from; empty disables both
+snapshot_dir = os.environ.get('snapshot_dir', '')
 
-def check_connection():
-    global conn
-    try:
-        with conn.cursor() as cur:
-            cur.execute("SELECT 1 FROM user_info")
-    except:
-        conn = _connectdb()
+
+def _connectdb(host=host, port=port):
+    return pg.connect(dbname=dbname, host=host, port=port,
+                      user=user, password=password,
+                      connect_timeout=connect_timeout,
+                      connection_factory=PreparingConnection)
+
+
+def _replica_pool(replica: str) -> ConnectionPool:
+    replica_host, _, replica_port = replica.partition(':')
+    # replicas connect on first use, so one being down doesn't stop startup
+    return ConnectionPool(lambda: _connectdb(replica_host, replica_port or port),
+                          0, pool_max, pool_timeout, pool_check_idle)
+
+
+# Database connection pool, connected on first use in each process; writes
+# and anything that must see them use connection, reads that may lag
+# slightly use read_connection
+pool = ConnectionPool(_connectdb, pool_min, pool_max, pool_timeout, pool_check_idle)
+connection = pool.connection
+
+router = ReplicaRouter(pool, [_replica_pool(replica) for replica in replicas], replica_retry,
+                       LocalBackend(token_cache_size), read_your_writes, secret_key)
+read_connection = router.connection
+
+# token -> user_id for tokens that recently validated
+token_cache = LocalBackend(token_cache_size)
+
+# versions of the catalog and reviews, for ETags; read from where the
+# responses they tag are read from
+data_versions = DataVersions(read_connection, version_ttl)
+
+catalog = Catalog(read_connection, data_versions, version_ttl) if in_memory_catalog else None
+snapshots = Snapshots(snapshot_dir, data_versions) if snapshot_dir else None
 
 
 def register(username, password) -> Optional[str]:
-    check_connection()
-    with conn.cursor() as cur:
-        query = "SELECT username FROM user_info WHERE username = %s;"
-        cur.execute(query, (username,))
+    # a taken username is turned away before it costs a hashing slot
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT 1 FROM user_info WHERE username = %s;", (username,))
+        if cur.rowcount != 0:
+            return None
 
-        if cur.rowcount == 0:
-            key, salt = login.hash(password)
-            token = uuid.uuid4().hex
-            query = """\
-                INSERT INTO user_info (username, token, password, salt) 
-                VALUES (%s, %s, %s, %s);"""
-            cur.execute(query, (username, token, key, salt))
-            conn.commit()
+    # hashed without holding a connection, so the pool isn't held while the
+    # key is derived; the UNIQUE username still rejects a concurrent duplicate
+    key, salt = login.hash(password)
+    token = uuid.uuid4().hex
+    with connection() as conn, conn.cursor() as cur:
+        query = """\
+            INSERT INTO user_info (username, token, password, salt, hash_scheme)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (username) DO NOTHING;"""
+        cur.execute(query, (username, token, key, salt, login.CURRENT_SCHEME))
+        conn.commit()
+        if cur.rowcount != 0:
             return token
 
     return None
 
 
 def token(username, password) -> Optional[str]:
-    check_connection()
-    with conn.cursor() as cur:
-        query = "SELECT token, password, salt FROM user_info WHERE username = %s;"
+    with connection() as conn, conn.cursor() as cur:
+        query = "SELECT token, password, salt, hash_scheme FROM user_info WHERE username = %s;"
         cur.execute(query, (username,))
-        if cur.rowcount != 0:
-            token, correct_password, salt = cur.fetchone()
-            attempted_password, salt = login.hash(password, salt)
-            print(attempted_password, correct_password, salt)
-            if attempted_password == correct_password:
-                return token
+        if cur.rowcount == 0:
+            return None
+        token, correct_password, salt, scheme = cur.fetchone()
 
+    if not login.verify(password, correct_password, salt, scheme):
         return None
 
+    if login.needs_rehash(scheme):
+        try:
+            key, salt = login.hash(password)
+        except HashBusy:
+            # the credentials were right; the upgrade waits for the next login
+            return token
+        with connection() as conn, conn.cursor() as cur:
+            query = """\
+                UPDATE user_info SET password=%s, salt=%s, hash_scheme=%s
+                WHERE username=%s;"""
+            cur.execute(query, (key, salt, login.CURRENT_SCHEME, username))
+            conn.commit()
+    return token
+
+
+def valid_token(token_str: str, cur=None) -> Optional[int]:
+    user_id = token_cache.get(token_str)
+    if user_id is not None:
+        metrics.CACHE_REQUESTS.inc('token', 'hit')
+        return user_id
+
+    if cur is None:
+        with connection() as conn, conn.cursor() as cur:
+            return valid_token(token_str, cur)
+
+    metrics.CACHE_REQUESTS.inc('token', 'miss')
+    query = "SELECT id FROM user_info WHERE token=%s;"
+    cur.execute(query, (token_str,))
+    if cur.rowcount != 0:
+        user_id = cur.fetchone()[0]
+        token_cache.set(token_str, user_id, token_cache_ttl)
+        return user_id
+    return None
 
-def valid_token(token_str: str) -> Optional[int]:
-    check_connection()
-    with conn.cursor() as cur:
-        query = "SELECT id FROM user_info WHERE token=%s;"
-        cur.execute(query, (token_str,))
-        if cur.rowcount != 0:
-            return cur.fetchone()[0]
-        return None
 
+def revoke_token(token_str: str):
+    token_cache.delete(token_str)
 
-def update(year, semester: Semester):
-    check_connection()
-    sections = scrape_courses(year, semester)
 
-    if not sections:
-        return
+def revoke_user(user_id: int):
+    with connection() as conn, conn.cursor() as cur:
+        query = "SELECT token FROM user_info WHERE id=%s;"
+        cur.execute(query, (user_id,))
+        if cur.rowcount != 0:
+            revoke_token(cur.fetchone()[0])
 
-    courses_d = dict()
-    instructors_d = dict()
-    teaching = set()
 
-    # courses & instructors
-    for subject, number, title, email, first, middle, last in sections:
-        courses_d.setdefault((subject, number), title)
-        instructors_d.setdefault(email, (first, middle, last))
-        teaching.add((year, semester.enum(), email, subject, number))
+def _no_stage(name: str):
+    return nullcontext()
 
-    courses = []
-    for key, value in courses_d.items():
-        courses.append((*key, value))
 
-    instructors = []
-    for key, value in instructors_d.items():
-        instructors.append((key, *value))
+def update(year, semester: Semester, stage: Callable = _no_stage) -> Optional[dict]:
+    # the scraping stack (requests, bs4) is only loaded by processes that update
+    from course import scrape_term_subjects
+    from ingest import changed_subjects, ingest_sections
 
-    with conn.cursor() as cur:
-        # insert courses
-        query = """\
-            INSERT INTO course (subject, course_no, title)
-            VALUES (%s, %s, %s) ON CONFLICT DO NOTHING;"""
-        cur.executemany(query, courses)
+    # sections are parsed while they download, so 'scrape' covers both
+    with stage('scrape'):
+        by_subject = scrape_term_subjects([(year, semester)])[(year, semester)]
 
-        # insert instructors
-        query = """\
-            INSERT INTO instructor (email, first_name, middle_name, last_name) 
-            VALUES (%s, %s, %s, %s) ON CONFLICT DO NOTHING;"""
-        cur.executemany(query, instructors)
+    if not any(by_subject.values()):
+        return None
 
-        # insert teachings
-        query = """\
-            INSERT INTO teaching (instructor_id, course_id, year, semester)
-            SELECT i.id, c.id, %s, %s
-            FROM    (SELECT id FROM instructor WHERE email=%s) i,
-                    (SELECT id FROM course WHERE subject=%s AND course_no=%s) c
-            ON CONFLICT DO NOTHING;"""
-        cur.executemany(query, list(teaching))
-        conn.commit()
-    logging.debug('Update complete')
+    with connection() as conn:
+        with stage('diff'):
+            changed = changed_subjects(conn, year, semester.enum(), by_subject)
+        if not changed:
+            logging.debug('update term=%s%s changed=0', year, semester.enum())
+            return None
+
+        with stage('insert'):
+            report = ingest_sections(conn, year, semester.enum(), changed)
+        # commits the ingest too, so readers never see the new rows under
+        # the old versions; other terms listing a renamed instructor or
+        # retitled course changed as well
+        terms = [f'{year}{semester.enum()}', *report['affected_terms']]
+        data_versions.bump(conn, ['catalog', *(f'catalog:{term}' for term in terms)])
+
+        if snapshots is not None:
+            # the terms are already committed, and their old snapshots no
+            # longer match their versions; without a new one /teaching just
+            # uses SQL for that term
+            with stage('snapshot'):
+                for term in terms:
+                    try:
+                        snapshots.write(conn, term[:4], term[4:])
+                    except OSError:
+                        logging.exception('snapshot term=%s failed', term)
+
+    if catalog is not None:
+        # other processes see the new version within version_ttl
+        catalog.expire()
+
+    report['subjects'] = {"changed": len(changed), "unchanged": len(by_subject) - len(changed)}
+    # review bodies embed instructor names and course titles
+    response_cache.invalidate('course', 'instructor', 'teaching', 'review')
+    logging.debug('update term=%s%s report=%s', year, semester.enum(), report)
+    return report
 
 
 if __name__ == '__main__':
+    logging.basicConfig(filename='debug.log', level=os.environ.get('log_level', 'WARNING').upper())
     update('2021', FALL)
@@ -1,3 +1,23 @@
 class InvalidTerm(Exception):
     def __init__(self, *args: object) -> None:
         super().__init__(*args)
+
+
+class PoolTimeout(Exception):
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
+
+
+class ScrapeError(Exception):
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
+
+
+class HashBusy(Exception):
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
+
+
+class WriteTimeout(Exception):
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
@@ -0,0 +1,308 @@
+import queries
+from semester import get_semester
+from serialize import (COURSE, INSTRUCTOR, REVIEW, TEACHING, course_json, instructor_json,
+                       json_response, review_json, teaching_json, to_columns)
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+DEFAULT_SEARCH_SIZE = 20
+
+# The read handlers are generators shared by the WSGI (app.py) and ASGI
+# (asgi.py) servers: each yields a Query, is sent back its rows, and
+# returns a Flask-style response value or a Stream. The servers only
+# differ in how they run the SQL.
+
+
+class Query:
+    def __init__(self, sql: str, params: tuple, stmt: queries.Statement = None) -> None:
+        self.sql = sql
+        self.params = params
+        # teaching/review queries also carry their prepared statement; the
+        # limit is the last parameter
+        self.stmt = stmt
+
+
+class Stream:
+    def __init__(self, sql: str, params: tuple, to_json) -> None:
+        self.sql = sql
+        self.params = params
+        self.to_json = to_json
+
+
+def id_list(value):
+    # "1,2,3" -> [1, 2, 3]; a ValueError makes args.get fall back to its
+    # default, as type=int does
+    return [int(v) for v in value.split(',')]
+
+
+def page_args(args):
+    limit = args.get('limit', default=DEFAULT_PAGE_SIZE, type=int)
+    after = args.get('after', default=0, type=int)
+    if not 0 < limit <= MAX_PAGE_SIZE:
+        return None, after
+    return limit, after
+
+
+def search_limit(args):
+    limit = args.get('limit', default=DEFAULT_SEARCH_SIZE, type=int)
+    if not 0 < limit <= MAX_PAGE_SIZE:
+        return None
+    return limit
+
+
+def contains_pattern(q):
+    escaped = q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f'%{escaped}%'
+
+
+def listing(args, key, schema, to_json, results, **extra):
+    if args.get('format') == 'columns':
+        body = to_columns(schema, results)
+    else:
+        body = [to_json(result) for result in results]
+    return json_response({"count": len(results), key: body, **extra})
+
+
+def select(table, filters, catalog=None):
+    # [(column, ILIKE pattern)] against the in-memory catalog when there is
+    # one and it can use an index, else the database
+    if catalog is not None:
+        results = getattr(catalog.snapshot(), table + 's').select(filters)
+        if results is not None:
+            return results
+
+    query = f"SELECT * FROM {table} WHERE TRUE"
+    for column, _ in filters:
+        query += f" AND {column} ILIKE %s"
+    return (yield Query(query + ";", tuple(value for _, value in filters)))
+
+
+def catalog_versions(args):
+    # the data_version names a listing's ETag is computed from
+    return ('catalog',)
+
+
+def teaching_versions(args):
+    # a single term only changes when that term is updated
+    year = args.get('year', default='', type=str)
+    semester = get_semester(args.get('semester', default='', type=str))
+    if len(year) == 4 and year.isdigit() and semester is not None:
+        return (f'catalog:{year}{semester.enum()}',)
+    return ('catalog',)
+
+
+def review_versions(args):
+    return ('catalog', 'review')
+
+
+def stats_versions(args):
+    return ('review',)
+
+
+def find_instructor(args, catalog=None):
+    q = args.get('q', default=None, type=str)
+    if q is not None:
+        return (yield from search_instructor(args, q))
+
+    filters = []
+    for column in ('email', 'first_name', 'middle_name', 'last_name'):
+        value = args.get(column, default=None, type=str)
+        if value is not None and value != '%':
+            filters.append((column, value))
+
+    results = yield from select('instructor', filters, catalog)
+    if results:
+        return listing(args, 'instructors', INSTRUCTOR, instructor_json, results)
+    return 'No instructor was found with the given parameters', 204
+
+
+def search_instructor(args, q):
+    limit = search_limit(args)
+    if limit is None:
+        return f'limit should be between 1 to {MAX_PAGE_SIZE}', 400
+
+    # matches the GIN trigram index on first_name || ' ' || last_name
+    query = """\
+        SELECT * FROM instructor
+        WHERE (first_name || ' ' || last_name) ILIKE %s
+        ORDER BY similarity(first_name || ' ' || last_name, %s) DESC, id
+        LIMIT %s;"""
+    results = yield Query(query, (contains_pattern(q), q, limit))
+    if results:
+        return listing(args, 'instructors', INSTRUCTOR, instructor_json, results)
+    return 'No instructor was found with the given parameters', 204
+
+
+def find_course(args, catalog=None):
+    q = args.get('q', default=None, type=str)
+    if q is not None:
+        return (yield from search_course(args, q))
+
+    subject = args.get('subject', default=None, type=str)
+    course_no = args.get('course_no', default=None, type=str)
+
+    filters = []
+    if subject is not None and subject != '%':
+        filters.append(('subject', subject))
+
+    if course_no is not None and course_no != '%':
+        if len(course_no) == 4:
+            course_no = course_no + " "
+        filters.append(('course_no', course_no))
+
+    results = yield from select('course', filters, catalog)
+    if results:
+        return listing(args, 'courses', COURSE, course_json, results)
+    return 'No course was found with the given parameters', 204
+
+
+def find_courses(args, data):
+    if not isinstance(data, dict) or not isinstance(data.get('courses'), list):
+        return 'courses is required', 400
+
+    if len(data['courses']) > MAX_PAGE_SIZE:
+        return f'At most {MAX_PAGE_SIZE} courses can be requested at once', 400
+
+    subjects = []
+    course_nos = []
+    for course in data['courses']:
+        if isinstance(course, dict):
+            course = (course.get('subject'), course.get('course_no'))
+        if not isinstance(course, (list, tuple)) or len(course) != 2 \
+                or not all(isinstance(v, str) for v in course):
+            return 'Each course should be a [subject, course_no] pair', 400
+        subjects.append(course[0].upper())
+        course_nos.append(course[1].upper())
+
+    query = """\
+        SELECT c.* FROM course c
+        INNER JOIN unnest(%s::CHAR(4)[], %s::CHAR(5)[]) k (subject, course_no)
+        ON c.subject = k.subject AND c.course_no = k.course_no
+        ORDER BY c.id;"""
+    results = yield Query(query, (subjects, course_nos))
+    if results:
+        return listing(args, 'courses', COURSE, course_json, results)
+    return 'No course was found with the given parameters', 204
+
+
+def search_course(args, q):
+    limit = search_limit(args)
+    if limit is None:
+        return f'limit should be between 1 to {MAX_PAGE_SIZE}', 400
+
+    # each side of the OR matches its own GIN trigram index
+    query = """\
+        SELECT * FROM course
+        WHERE title ILIKE %s
+        OR (subject || course_no) ILIKE %s
+        ORDER BY GREATEST(similarity(title, %s),
+                          similarity(subject || course_no, %s)) DESC, id
+        LIMIT %s;"""
+    code = q.replace(' ', '')
+    results = yield Query(query, (contains_pattern(q), contains_pattern(code),
+                                  q, code, limit))
+    if results:
+        return listing(args, 'courses', COURSE, course_json, results)
+    return 'No course was found with the given parameters', 204
+
+
+def _paged(args, kind, key, schema, to_json, empty):
+    instructor_id = args.get('instructor_id', default=None, type=id_list)
+    course_id = args.get('course_id', default=None, type=id_list)
+    year = args.get('year', default='%', type=str)
+    semester_raw = args.get('semester', default=None, type=str)
+    limit, after = page_args(args)
+    if limit is None:
+        return f'limit should be between 1 to {MAX_PAGE_SIZE}', 400
+
+    semester = None
+    if semester_raw:
+        semester = get_semester(semester_raw)
+        if semester is None:
+            return 'Provided semester is not valid', 400
+
+    stmt, params = queries.statement(kind, {
+        'after': after,
+        'year': None if year == '%' else year,
+        'semester': semester.enum() if semester else None,
+        'instructor_id': instructor_id,
+        'course_id': course_id
+    })
+
+    if args.get('format') == 'ndjson':
+        return Stream(stmt.sql(), tuple(params), to_json)
+
+    results = yield Query(stmt.sql() + " LIMIT %s;", (*params, limit + 1), stmt)
+    if results:
+        next_id = results[limit - 1][0] if len(results) > limit else None
+        return listing(args, key, schema, to_json, results[:limit], next=next_id)
+    return empty, 204
+
+
+def term_snapshot(args, snapshots):
+    # a single term's listing straight from its snapshot file, or None to
+    # use SQL; only the filters the snapshot is keyed on are supported
+    if args.get('instructor_id', default=None, type=id_list) is not None \
+            or args.get('course_id', default=None, type=id_list) is not None \
+            or args.get('format') == 'columns':
+        return None
+
+    year = args.get('year', default='%', type=str)
+    semester = get_semester(args.get('semester', default='', type=str))
+    limit, after = page_args(args)
+    if year == '%' or semester is None or limit is None:
+        return None
+
+    snapshot = snapshots.get(year, semester.enum())
+    if snapshot is None:
+        return None
+
+    if args.get('format') == 'ndjson':
+        return snapshot.rows(after), 200, {'Content-Type': 'application/x-ndjson'}
+
+    rows, count, next_id = snapshot.page(after, limit)
+    if not count:
+        return 'No teaching was found with the given parameters', 204
+    # the bytes json_response would produce for the same listing
+    body = b'{"count":%d,"next":%s,"teachings":[%s]}\n' % (
+        count, b'null' if next_id is None else b'%d' % next_id, rows)
+    return body, 200, {'Content-Type': 'application/json'}
+
+
+def find_teaching(args, snapshots=None):
+    if snapshots is not None:
+        result = term_snapshot(args, snapshots)
+        if result is not None:
+            return result
+
+    return (yield from _paged(args, 'teaching', 'teachings', TEACHING, teaching_json,
+                              'No teaching was found with the given parameters'))
+
+
+def get_review(args):
+    return (yield from _paged(args, 'review', 'reviews', REVIEW, review_json,
+                              'No review was found with the given parameters'))
+
+
+def rating_stats(scope, target_id):
+    query = """\
+        SELECT  review_count, instructor_rating_sum, difficulty_rating_sum,
+                instructor_histogram, difficulty_histogram
+        FROM rating_summary
+        WHERE scope=%s AND target_id=%s;"""
+    results = yield Query(query, (scope, target_id))
+    result = results[0] if results else (0, 0, 0, [0] * 5, [0] * 5)
+
+    count = result[0]
+    return {
+        "id": target_id,
+        "count": count,
+        "instructor_rating": {
+            "mean": result[1] / count if count else None,
+            "histogram": dict(zip("12345", result[3]))
+        },
+        "difficulty_rating": {
+            "mean": result[2] / count if count else None,
+            "histogram": dict(zip("12345", result[4]))
+        }
+    }
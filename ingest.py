@@ -0,0 +1,183 @@
+import hashlib
+import io
+from typing import Dict, Iterable
+
+SECTION_COLUMNS = ('subject', 'course_no', 'title',
+                   'email', 'first_name', 'middle_name', 'last_name')
+
+
+def _escape(value) -> str:
+    if value is None:
+        return '\\N'
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def copy_rows(cur, table: str, columns: Iterable[str], rows: Iterable[tuple]) -> None:
+    buf = io.StringIO()
+    for row in rows:
+        buf.write('\t'.join(_escape(value) for value in row))
+        buf.write('\n')
+    buf.seek(0)
+    cur.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buf)
+
+
+def fingerprint(sections: Iterable[tuple]) -> str:
+    digest = hashlib.sha256()
+    for section in sorted(sections):
+        digest.update('\x1f'.join(section).encode('utf-8'))
+        digest.update(b'\x1e')
+    return digest.hexdigest()
+
+
+def load_fingerprints(conn, year: str, semester_enum: str) -> Dict[str, str]:
+    with conn.cursor() as cur:
+        query = """\
+            SELECT subject, digest FROM term_fingerprint
+            WHERE year=%s AND semester=%s;"""
+        cur.execute(query, (year, semester_enum))
+        return {subject.strip(): digest for subject, digest in cur.fetchall()}
+
+
+def changed_subjects(conn, year: str, semester_enum: str,
+                     by_subject: Dict[str, set]) -> Dict[str, set]:
+    fingerprints = load_fingerprints(conn, year, semester_enum)
+    return {
+        subject: sections
+        for subject, sections in by_subject.items()
+        if fingerprints.get(subject) != fingerprint(sections)
+    }
+
+
+def ingest_sections(conn, year: str, semester_enum: str, by_subject: Dict[str, set]) -> dict:
+    # by_subject holds the complete scraped listing of each subject; anything
+    # stored for those subjects in this term that isn't listed is removed
+    with conn.cursor() as cur:
+        cur.execute("""\
+            CREATE TEMP TABLE stage_section (
+                subject CHAR(4),
+                course_no CHAR(5),
+                title VARCHAR(255),
+                email VARCHAR(255),
+                first_name VARCHAR(255),
+                middle_name VARCHAR(255),
+                last_name VARCHAR(255)
+            ) ON COMMIT DROP;""")
+        copy_rows(cur, 'stage_section', SECTION_COLUMNS,
+                  (section for sections in by_subject.values() for section in sections))
+
+        cur.execute("""\
+            CREATE TEMP TABLE stage_subject (
+                subject CHAR(4),
+                digest CHAR(64)
+            ) ON COMMIT DROP;""")
+        copy_rows(cur, 'stage_subject', ('subject', 'digest'),
+                  ((subject, fingerprint(sections)) for subject, sections in by_subject.items()))
+
+        cur.execute("""\
+            SELECT  COUNT(DISTINCT (subject, course_no)),
+                    COUNT(DISTINCT email),
+                    COUNT(DISTINCT (email, subject, course_no))
+            FROM stage_section;""")
+        staged = dict(zip(('course', 'instructor', 'teaching'), cur.fetchone()))
+
+        report = {table: {"inserted": 0, "modified": 0, "removed": 0} for table in staged}
+
+        # courses: pick up title changes, then insert new ones; sections of
+        # one course can disagree on the title, so the pick must not depend
+        # on row order or the title would flip on every refresh
+        cur.execute("""\
+            UPDATE course c SET title = s.title
+            FROM (
+                SELECT DISTINCT ON (subject, course_no) subject, course_no, title
+                FROM stage_section
+                ORDER BY subject, course_no, title
+            ) s
+            WHERE c.subject = s.subject AND c.course_no = s.course_no
+            AND c.title IS DISTINCT FROM s.title
+            RETURNING c.id;""")
+        report['course']['modified'] = cur.rowcount
+        modified_courses = [row[0] for row in cur.fetchall()]
+
+        cur.execute("""\
+            INSERT INTO course (subject, course_no, title)
+            SELECT DISTINCT ON (subject, course_no) subject, course_no, title
+            FROM stage_section
+            ORDER BY subject, course_no, title
+            ON CONFLICT DO NOTHING;""")
+        report['course']['inserted'] = cur.rowcount
+
+        # instructors: pick up name changes, then insert new ones (with the
+        # same deterministic pick)
+        cur.execute("""\
+            UPDATE instructor i
+            SET first_name = s.first_name, middle_name = s.middle_name, last_name = s.last_name
+            FROM (
+                SELECT DISTINCT ON (email) email, first_name, middle_name, last_name
+                FROM stage_section
+                ORDER BY email, first_name, middle_name, last_name
+            ) s
+            WHERE i.email = s.email
+            AND (i.first_name, i.middle_name, i.last_name)
+                IS DISTINCT FROM (s.first_name, s.middle_name, s.last_name)
+            RETURNING i.id;""")
+        report['instructor']['modified'] = cur.rowcount
+        modified_instructors = [row[0] for row in cur.fetchall()]
+
+        # a renamed instructor or retitled course changes the listings of
+        # every other term that has them too
+        cur.execute("""\
+            SELECT DISTINCT year, semester FROM teaching
+            WHERE (course_id = ANY(%s) OR instructor_id = ANY(%s))
+            AND (year, semester) <> (%s, %s::SEMESTER);""",
+                    (modified_courses, modified_instructors, year, semester_enum))
+        affected_terms = sorted(f'{y}{s}' for y, s in cur.fetchall())
+
+        cur.execute("""\
+            INSERT INTO instructor (email, first_name, middle_name, last_name)
+            SELECT DISTINCT ON (email) email, first_name, middle_name, last_name
+            FROM stage_section
+            ORDER BY email, first_name, middle_name, last_name
+            ON CONFLICT DO NOTHING;""")
+        report['instructor']['inserted'] = cur.rowcount
+
+        # teachings: insert new ones, resolving both ids with one join
+        cur.execute("""\
+            INSERT INTO teaching (instructor_id, course_id, year, semester)
+            SELECT DISTINCT i.id, c.id, %s::CHAR(4), %s::SEMESTER
+            FROM stage_section s
+            INNER JOIN instructor i ON i.email = s.email
+            INNER JOIN course c ON c.subject = s.subject AND c.course_no = s.course_no
+            ON CONFLICT DO NOTHING;""", (year, semester_enum))
+        report['teaching']['inserted'] = cur.rowcount
+
+        # drop teachings of the refreshed subjects that are no longer listed
+        # (e.g. an instructor swap), keeping any that already have reviews
+        cur.execute("""\
+            DELETE FROM teaching t
+            USING course c, instructor i
+            WHERE t.course_id = c.id AND t.instructor_id = i.id
+            AND t.year = %s AND t.semester = %s
+            AND c.subject IN (SELECT subject FROM stage_subject)
+            AND NOT EXISTS (
+                SELECT 1 FROM stage_section s
+                WHERE s.email = i.email
+                AND s.subject = c.subject AND s.course_no = c.course_no
+            )
+            AND NOT EXISTS (SELECT 1 FROM review r WHERE r.teaching_id = t.id);""",
+                    (year, semester_enum))
+        report['teaching']['removed'] = cur.rowcount
+
+        cur.execute("""\
+            INSERT INTO term_fingerprint (year, semester, subject, digest)
+            SELECT %s, %s, subject, digest FROM stage_subject
+            ON CONFLICT (year, semester, subject) DO UPDATE SET digest = EXCLUDED.digest;""",
+                    (year, semester_enum))
+        cur.execute("DROP TABLE stage_section, stage_subject;")
+
+    # left to the caller to commit, together with the data versions that
+    # tell readers the term changed
+    for table, counts in report.items():
+        counts["skipped"] = staged[table] - counts["inserted"] - counts["modified"]
+    report['affected_terms'] = affected_terms
+    return report
@@ -0,0 +1,209 @@
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Iterable, Optional, Tuple
+
+from psycopg2.extras import Json
+
+import metrics
+from semester import Semester, get_semester
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+
+
+JOB_COLUMNS = 'id, year, semester, status, created, started, finished, stages, report, error'
+
+# first key of the advisory locks taken per term (the second is the term)
+SUBMIT_LOCK = 4370
+RUN_LOCK = 4371
+
+
+class Job:
+    def __init__(self, year: str, semester: Semester) -> None:
+        self.id = uuid.uuid4().hex
+        self.year = year
+        self.semester = semester
+        self.status = QUEUED
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.stages = OrderedDict()
+        self.report = None
+        self.error = None
+        # called after each stage, to publish progress
+        self.on_stage = None
+
+    @classmethod
+    def from_row(cls, row: tuple) -> 'Job':
+        job_id, year, semester, status, created, started, finished, stages, report, error = row
+        job = cls(year, get_semester(semester))
+        job.id = job_id
+        job.status = status
+        job.created = created
+        job.started = started
+        job.finished = finished
+        job.stages = OrderedDict(stages)
+        job.report = report
+        job.error = error
+        return job
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = time.perf_counter() - start
+            metrics.UPDATE_STAGE_SECONDS.observe(self.stages[name], name)
+            if self.on_stage is not None:
+                self.on_stage(self)
+
+    def to_json(self) -> dict:
+        return {
+            "id": self.id,
+            "year": self.year,
+            "semester": self.semester.enum(),
+            "status": self.status,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "stages": dict(self.stages),
+            "report": self.report,
+            "error": self.error
+        }
+
+
+class JobScheduler:
+    # Jobs are kept in the update_job table so every serving process sees
+    # the same ones; each runs in the process that submitted it. Advisory
+    # locks on the term dedupe submissions and let only one job per term
+    # run at a time, across processes.
+    def __init__(self, target: Callable, connect: Callable, max_workers: int, history: int,
+                 timeout: float) -> None:
+        self.target = target
+        self.connect = connect
+        self.history = history
+        # a job still queued after this many seconds is taken to have lost
+        # its process
+        self.timeout = timeout
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix='update')
+        self._timer = None
+
+    def submit(self, year: str, semester: Semester, since: Optional[float] = None) -> Job:
+        # since: also reuse any job on the term created after this time
+        term = f'{year}{semester.enum()}'
+        with self.connect() as conn, conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_xact_lock(%s, hashtext(%s));", (SUBMIT_LOCK, term))
+            cur.execute("""\
+                UPDATE update_job SET status=%s, error=%s
+                WHERE year=%s AND semester=%s AND status=%s AND created < %s;""",
+                        (FAILED, 'abandoned', year, semester.enum(), QUEUED,
+                         time.time() - self.timeout))
+
+            # a queued job has not scraped yet, so it already covers this
+            # request; a running one may be past its scrape, so at most one
+            # follow-up job is queued behind it
+            cur.execute(f"""\
+                SELECT {JOB_COLUMNS} FROM update_job
+                WHERE year=%s AND semester=%s AND (status=%s OR created > %s)
+                ORDER BY created DESC
+                LIMIT 1;""", (year, semester.enum(), QUEUED,
+                              float('inf') if since is None else since))
+            if cur.rowcount != 0:
+                job = Job.from_row(cur.fetchone())
+                conn.commit()
+                return job
+
+            job = Job(year, semester)
+            cur.execute("""\
+                INSERT INTO update_job (id, year, semester, status, created)
+                VALUES (%s, %s, %s, %s, %s);""",
+                        (job.id, year, semester.enum(), job.status, job.created))
+            cur.execute("""\
+                DELETE FROM update_job
+                WHERE status IN (%s, %s) AND created <= (
+                    SELECT created FROM update_job
+                    ORDER BY created DESC
+                    OFFSET %s LIMIT 1
+                );""", (SUCCEEDED, FAILED, self.history))
+            conn.commit()
+
+        job.on_stage = self._save
+        self._executor.submit(self._run, job)
+        return job
+
+    def _run(self, job: Job):
+        term = f'{job.year}{job.semester.enum()}'
+        try:
+            with self.connect() as conn, conn.cursor() as cur:
+                # waits for an earlier job on the same term, in any process,
+                # to finish; held until this transaction ends with the job
+                cur.execute("SELECT pg_advisory_xact_lock(%s, hashtext(%s));", (RUN_LOCK, term))
+                job.status = RUNNING
+                job.started = time.time()
+                self._save(job)
+
+                job.report = self.target(job.year, job.semester, stage=job.stage)
+                job.status = SUCCEEDED
+        except Exception as e:
+            logging.exception('update job=%s failed', job.id)
+            job.error = repr(e)
+            job.status = FAILED
+        finally:
+            job.finished = time.time()
+            metrics.UPDATE_JOBS.inc(job.status)
+            self._save(job)
+
+    def _save(self, job: Job):
+        try:
+            with self.connect() as conn, conn.cursor() as cur:
+                cur.execute("""\
+                    UPDATE update_job
+                    SET status=%s, started=%s, finished=%s, stages=%s, report=%s, error=%s
+                    WHERE id=%s;""",
+                            (job.status, job.started, job.finished, Json(job.stages),
+                             None if job.report is None else Json(job.report), job.error, job.id))
+                conn.commit()
+        except Exception:
+            # the job itself carries on; only its progress report is stale
+            logging.exception('update job=%s could not be saved', job.id)
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self.connect() as conn, conn.cursor() as cur:
+            cur.execute(f"SELECT {JOB_COLUMNS} FROM update_job WHERE id=%s;", (job_id,))
+            if cur.rowcount == 0:
+                return None
+            return Job.from_row(cur.fetchone())
+
+    def schedule(self, terms: Iterable[Tuple[str, Semester]], interval: float):
+        # every serving process runs this timer; a term already submitted
+        # in the last half interval (by any of them) is skipped, so each
+        # interval scrapes a term about once
+        terms = list(terms)
+
+        def tick():
+            for year, semester in terms:
+                try:
+                    self.submit(year, semester, since=time.time() - interval / 2)
+                except Exception:
+                    logging.exception('scheduled update term=%s%s failed to submit',
+                                      year, semester.enum())
+            self._timer = threading.Timer(interval, tick)
+            self._timer.daemon = True
+            self._timer.start()
+
+        tick()
+
+    def shutdown(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._executor.shutdown(wait=False, cancel_futures=True)
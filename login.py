@@ -1,24 +1,89 @@
 import hashlib
+import hmac
 import os
-from typing import Tuple
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+from dotenv import load_dotenv
+
+from exception import HashBusy
+
+load_dotenv()
 
 HASH_ALGORITHM = 'sha256'
 ENCODING = 'utf-8'
 DIGEST_SIZE = 32
 ITERATION = 100_000
 
+# stored as user_info.hash_scheme; NULL means the original pbkdf2 format
+LEGACY_SCHEME = f'pbkdf2_{HASH_ALGORITHM}${ITERATION}'
+CURRENT_SCHEME = os.environ.get('hash_scheme', LEGACY_SCHEME)
+
+hash_workers = int(os.environ.get('hash_workers', 2))
+hash_queue = int(os.environ.get('hash_queue', 8))
+hash_retry_after = int(os.environ.get('hash_retry_after', 1))
+
+# pbkdf2_hmac and scrypt release the GIL, so a small thread pool keeps the
+# hashing off the request threads without the cost of a process pool
+_executor = ThreadPoolExecutor(max_workers=hash_workers, thread_name_prefix='hash')
+_slots = threading.BoundedSemaphore(hash_workers + hash_queue)
+
+
+def _derive(password: str, salt: bytes, scheme: str) -> bytes:
+    name, *params = scheme.split('$')
+    if name == f'pbkdf2_{HASH_ALGORITHM}':
+        iteration, = params
+        return hashlib.pbkdf2_hmac(
+            HASH_ALGORITHM,
+            password.encode(ENCODING),
+            salt,
+            int(iteration),
+            dklen=DIGEST_SIZE
+        )
+
+    if name == 'scrypt':
+        n, r, p = params
+        return hashlib.scrypt(
+            password.encode(ENCODING),
+            salt=salt,
+            n=int(n),
+            r=int(r),
+            p=int(p),
+            maxmem=256 * int(n) * int(r) + 1024 * 1024,
+            dklen=DIGEST_SIZE
+        )
+
+    raise ValueError(f'Unknown hash scheme: {scheme}')
 
-def hash(password: str, salt_str: str = None) -> Tuple[str, str]:
+
+def _submit(fn, *args):
+    if not _slots.acquire(blocking=False):
+        raise HashBusy('Too many password hashes in progress', hash_retry_after)
+
+    try:
+        future = _executor.submit(fn, *args)
+    except:
+        _slots.release()
+        raise
+    future.add_done_callback(lambda _: _slots.release())
+    return future.result()
+
+
+def hash(password: str, salt_str: str = None, scheme: str = None) -> Tuple[str, str]:
     if salt_str is None:
         salt = os.urandom(DIGEST_SIZE)
     else:
         salt = bytes.fromhex(salt_str)
 
-    key = hashlib.pbkdf2_hmac(
-        HASH_ALGORITHM,
-        password.encode(ENCODING),
-        salt,
-        ITERATION,
-        dklen=DIGEST_SIZE
-    )
+    key = _submit(_derive, password, salt, scheme or CURRENT_SCHEME)
     return key.hex(), salt.hex()
+
+
+def verify(password: str, key_str: str, salt_str: str, scheme: Optional[str]) -> bool:
+    attempted, _ = hash(password, salt_str, scheme or LEGACY_SCHEME)
+    return hmac.compare_digest(attempted, key_str)
+
+
+def needs_rehash(scheme: Optional[str]) -> bool:
+    return (scheme or LEGACY_SCHEME) != CURRENT_SCHEME
@@ -0,0 +1,224 @@
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, Sequence, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# queries slower than this are logged as warnings; 0 disables
+slow_query_ms = float(os.environ.get('slow_query_ms', 0))
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# upper bounds, in seconds
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+STAGE_BUCKETS = (.1, .5, 1, 5, 10, 30, 60, 120, 300, 600)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50)
+BATCH_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+logger = logging.getLogger(__name__)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names: Sequence[str], values: Sequence, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+        self._values = dict()
+        self._lock = threading.Lock()
+
+    def samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def render(self) -> Iterator[str]:
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} {self.kind}'
+        yield from self.samples()
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def set(self, value: float, *labels):
+        # for counts another component already keeps, copied in at scrape time
+        with self._lock:
+            self._values[labels] = value
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            yield f'{self.name}{_labels(self.labels, labels)} {value}'
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                # per-bucket (not cumulative) counts, then sum
+                state = self._values[labels] = [0] * (len(self.buckets) + 1) + [0]
+            state[i] += 1
+            state[-1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            values = sorted((labels, list(state)) for labels, state in self._values.items())
+        for labels, state in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), state):
+                cumulative += count
+                le = f'le="{bound}"'
+                yield f'{self.name}_bucket{_labels(self.labels, labels, le)} {cumulative}'
+            yield f'{self.name}_sum{_labels(self.labels, labels)} {state[-1]}'
+            yield f'{self.name}_count{_labels(self.labels, labels)} {cumulative}'
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics = []
+        self.hooks = []
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        metric = Counter(name, help, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        metric = Histogram(name, help, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def hook(self, fn: Callable[[], None]):
+        # run before every render, to copy in values kept elsewhere
+        self.hooks.append(fn)
+
+    def render(self) -> str:
+        for fn in self.hooks:
+            fn()
+        return ''.join(f'{line}\n' for metric in self.metrics for line in metric.render())
+
+
+registry = Registry()
+
+REQUEST_SECONDS = registry.histogram(
+    'http_request_duration_seconds', 'Time to produce a response, by route',
+    ('route', 'method', 'status'))
+REQUEST_QUERIES = registry.histogram(
+    'http_request_db_queries', 'Database queries run per request, by route',
+    ('route',), COUNT_BUCKETS)
+REQUEST_DB_SECONDS = registry.histogram(
+    'http_request_db_seconds', 'Time spent in the database per request, by route', ('route',))
+QUERY_SECONDS = registry.histogram(
+    'db_query_duration_seconds', 'Database statement latency, by leading keyword', ('statement',))
+SLOW_QUERIES = registry.counter(
+    'db_slow_queries_total', 'Statements slower than slow_query_ms')
+POOL_WAIT_SECONDS = registry.histogram(
+    'db_pool_wait_seconds', 'Time spent waiting to check out a connection')
+POOL_TIMEOUTS = registry.counter(
+    'db_pool_timeouts_total', 'Checkouts that gave up waiting for a connection')
+DB_READS = registry.counter(
+    'db_reads_total', 'Read checkouts that completed, by server', ('server',))
+REPLICA_FAILURES = registry.counter(
+    'db_replica_failures_total', 'Times a replica was taken out of rotation', ('replica',))
+CACHE_REQUESTS = registry.counter(
+    'cache_requests_total', 'Cache lookups, by cache and result', ('cache', 'result'))
+SCRAPE_SECONDS = registry.histogram(
+    'scrape_subject_duration_seconds', 'Time to download and parse one subject listing',
+    buckets=STAGE_BUCKETS)
+SCRAPE_FAILURES = registry.counter(
+    'scrape_request_failures_total', 'SIS requests that failed and were retried or given up on')
+UPDATE_STAGE_SECONDS = registry.histogram(
+    'update_stage_duration_seconds', 'Duration of each stage of a term update', ('stage',),
+    STAGE_BUCKETS)
+UPDATE_JOBS = registry.counter(
+    'update_jobs_total', 'Finished term update jobs, by status', ('status',))
+GROUP_COMMIT_SIZE = registry.histogram(
+    'group_commit_batch_size', 'Statements committed together by the write-behind path',
+    buckets=BATCH_BUCKETS)
+GROUP_COMMIT_SECONDS = registry.histogram(
+    'group_commit_duration_seconds', 'Time to COMMIT one write-behind batch')
+
+_request = threading.local()
+
+
+def begin_request():
+    _request.queries = 0
+    _request.seconds = 0.0
+
+
+def end_request() -> Tuple[int, float]:
+    queries, seconds = getattr(_request, 'queries', None) or 0, getattr(_request, 'seconds', 0.0)
+    # queries outside a request (streamed bodies, update jobs) aren't counted
+    _request.queries = None
+    return queries, seconds
+
+
+def observe_query(query, seconds: float):
+    # called by queries.TimedCursor for every statement
+    words = query.split(None, 2) if isinstance(query, str) else None
+    if not words:
+        statement = 'OTHER'
+    elif words[0].upper() in ('PREPARE', 'EXECUTE') and len(words) > 1:
+        # one label per prepared statement, e.g. "EXECUTE review_5"
+        statement = f'{words[0].upper()} {words[1]}'
+    else:
+        statement = words[0].upper()
+    QUERY_SECONDS.observe(seconds, statement)
+
+    if getattr(_request, 'queries', None) is not None:
+        _request.queries += 1
+        _request.seconds += seconds
+
+    if slow_query_ms and seconds * 1000 >= slow_query_ms:
+        SLOW_QUERIES.inc()
+        logger.warning('slow query seconds=%.3f statement=%r', seconds, query)
+
+
+def cache_stats_hook(cache_name: str, stats: Callable[[], Dict[str, dict]]):
+    # mirrors a ResponseCache's per-namespace hits and misses
+    def copy():
+        for namespace, counts in stats().items():
+            CACHE_REQUESTS.set(counts['hits'], f'{cache_name}:{namespace}', 'hit')
+            CACHE_REQUESTS.set(counts['misses'], f'{cache_name}:{namespace}', 'miss')
+    registry.hook(copy)
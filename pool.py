@@ -0,0 +1,226 @@
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import ExitStack, contextmanager
+from typing import Callable, Iterator, Optional, Sequence
+
+import psycopg2 as pg
+from itsdangerous import BadSignature, TimestampSigner
+from psycopg2 import extensions
+
+import metrics
+from exception import PoolTimeout
+
+
+# admin_shutdown, crash_shutdown, cannot_connect_now
+DISCONNECT_CODES = ('57P01', '57P02', '57P03')
+
+
+def disconnected(e: Exception) -> bool:
+    # for an OperationalError or InterfaceError (psycopg2 or 3): the server
+    # went away or the connection was dropped, as opposed to the statement
+    # failing (cancelled, deadlock, ...); only then can a new connection help
+    code = getattr(e, 'pgcode', None) or getattr(e, 'sqlstate', None)
+    return code is None or code.startswith('08') or code in DISCONNECT_CODES
+
+
+class ConnectionPool:
+    def __init__(self, connect: Callable, minconn: int, maxconn: int, timeout: float,
+                 check_idle: float = 30) -> None:
+        self.connect = connect
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        # connections idle longer than this are pinged before being handed
+        # out, since a restart or idle timeout may have dropped them
+        self.check_idle = check_idle
+
+        self._idle = deque()
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(maxconn)
+        # connections are opened on first use in each process, so a server
+        # that imports the app before forking workers shares none of them
+        self._pid = None
+        self._inherited = []
+
+    def _open(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            # anything left from the parent is its session: closing it here
+            # would end it there too, so it's only kept from being collected
+            self._inherited.extend(self._idle)
+            self._idle = deque()
+            self._slots = threading.BoundedSemaphore(self.maxconn)
+            self._pid = pid
+            for _ in range(self.minconn):
+                self._idle.append((self.connect(), time.monotonic()))
+
+    def getconn(self):
+        self._open()
+        start = time.perf_counter()
+        acquired = self._slots.acquire(timeout=self.timeout)
+        metrics.POOL_WAIT_SECONDS.observe(time.perf_counter() - start)
+        if not acquired:
+            metrics.POOL_TIMEOUTS.inc()
+            raise PoolTimeout(f'No database connection available after {self.timeout}s')
+
+        try:
+            with self._lock:
+                conn, since = self._idle.pop() if self._idle else (None, 0)
+            if conn is not None and not conn.closed \
+                    and time.monotonic() - since > self.check_idle and not self._alive(conn):
+                # the rest were probably dropped along with it
+                self.closeall()
+            if conn is None or conn.closed:
+                conn = self.connect()
+            return conn
+        except:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn, discard: bool = False):
+        try:
+            if not conn.closed and not discard:
+                status = conn.info.transaction_status
+                if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+                    discard = True
+                elif status != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+
+            if conn.closed or discard:
+                conn.close()
+            else:
+                with self._lock:
+                    self._idle.append((conn, time.monotonic()))
+        finally:
+            self._slots.release()
+
+    def _alive(self, conn) -> bool:
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1;")
+            conn.rollback()
+            return True
+        except pg.Error:
+            conn.close()
+            return False
+
+    @contextmanager
+    def connection(self):
+        conn = self.getconn()
+        try:
+            yield conn
+        except (pg.OperationalError, pg.InterfaceError):
+            # a closed connection means the server went away, and usually
+            # dropped the idle ones too; a cancelled statement or deadlock
+            # leaves the session usable
+            closed = conn.closed
+            self.putconn(conn, discard=closed)
+            if closed:
+                self.closeall()
+            raise
+        except:
+            self.putconn(conn)
+            raise
+        else:
+            self.putconn(conn)
+
+    def closeall(self):
+        with self._lock:
+            while self._idle:
+                self._idle.pop()[0].close()
+
+
+class ReplicaRouter:
+    # Sends reads to the replicas round-robin. A replica that fails to
+    # connect, or drops a connection mid-query, is skipped for retry_after
+    # seconds and then tried again; with none available reads go to primary.
+    def __init__(self, primary: ConnectionPool, replicas: Sequence[ConnectionPool],
+                 retry_after: float, pins=None, pin_ttl: float = 0,
+                 secret: Optional[str] = None) -> None:
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.retry_after = retry_after
+        # read-your-writes: keys (auth tokens) whose reads stay on primary,
+        # and signed pins that clients carry to the other processes
+        self.pins = pins
+        self.pin_ttl = pin_ttl
+        self._signer = TimestampSigner(secret, salt='read-your-writes') if secret else None
+
+        self._down = dict()
+        self._next = itertools.count()
+
+    def candidates(self) -> Iterator[int]:
+        if not self.replicas:
+            return
+        now = time.monotonic()
+        start = next(self._next)
+        for i in range(len(self.replicas)):
+            index = (start + i) % len(self.replicas)
+            if self._down.get(index, 0) <= now:
+                yield index
+
+    def mark_down(self, index: int, reason):
+        self._down[index] = time.monotonic() + self.retry_after
+        metrics.REPLICA_FAILURES.inc(index)
+        logging.warning('replica index=%s down for %ss: %s', index, self.retry_after, reason)
+
+    def pin(self, key: Optional[str]) -> Optional[str]:
+        # returns a signed pin for the client to carry to whichever process
+        # serves its next reads, if there's a secret to sign it with
+        if self.pin_ttl <= 0:
+            return None
+        if key and self.pins is not None:
+            self.pins.set(key, True, self.pin_ttl)
+        if self._signer is None:
+            return None
+        return self._signer.sign('primary').decode('utf-8')
+
+    def pinned(self, key: Optional[str], signed: Optional[str] = None) -> bool:
+        # a pin the client carried back, or one this process recorded
+        if self.pin_ttl <= 0:
+            return False
+        if signed and self._signer is not None:
+            try:
+                # rejects forged, expired and future-dated pins
+                self._signer.unsign(signed, max_age=self.pin_ttl)
+                return True
+            except BadSignature:
+                pass
+        return bool(key) and self.pins is not None and self.pins.get(key) is not None
+
+    @contextmanager
+    def connection(self, primary: bool = False):
+        for index in ([] if primary else self.candidates()):
+            stack = ExitStack()
+            try:
+                conn = stack.enter_context(self.replicas[index].connection())
+            except pg.OperationalError as e:
+                self.mark_down(index, e)
+                continue
+            except PoolTimeout:
+                # busy rather than broken; the next replica may have room
+                continue
+
+            with stack:
+                try:
+                    yield conn
+                except (pg.OperationalError, pg.InterfaceError) as e:
+                    # a closed connection means the server went away, as
+                    # opposed to e.g. a cancelled statement
+                    if conn.closed:
+                        self.mark_down(index, e)
+                    raise
+            metrics.DB_READS.inc('replica')
+            return
+
+        with self.primary.connection() as conn:
+            yield conn
+        metrics.DB_READS.inc('primary')
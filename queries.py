@@ -0,0 +1,158 @@
+import time
+from typing import Dict, List, Sequence, Tuple
+
+from psycopg2 import errors, extensions
+
+import metrics
+
+
+class TimedCursor(extensions.cursor):
+    # reports every statement's latency to metrics
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            metrics.observe_query(query, time.perf_counter() - start)
+
+    def copy_expert(self, sql, file, size=8192):
+        start = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            metrics.observe_query(sql, time.perf_counter() - start)
+
+
+class PreparingConnection(extensions.connection):
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.cursor_factory = TimedCursor
+        # names of the statements PREPAREd on this session
+        self.prepared = set()
+
+
+class Statement:
+    def __init__(self, name: str, select: str, order: str,
+                 filters: Sequence[Tuple[str, str]]) -> None:
+        self.name = name
+        self.select = select
+        self.order = order
+        self.filters = filters
+
+    def _where(self, placeholder) -> str:
+        return ''.join(f"\n            AND {predicate.format(placeholder(i + 1))}"
+                       for i, (_, predicate) in enumerate(self.filters))
+
+    def prepare_sql(self) -> str:
+        limit = f'${len(self.filters) + 1}'
+        return f"{self.select}{self._where(lambda i: f'${i}')}\n        ORDER BY {self.order}\n        LIMIT {limit}"
+
+    def sql(self) -> str:
+        return f"{self.select}{self._where(lambda i: '%s')}\n        ORDER BY {self.order}"
+
+
+# each filter is (argument, predicate); 'after' is always present so a
+# statement exists per combination of the optional ones
+TEACHING_SELECT = """\
+        SELECT  t.id,
+                i.id, i.email, i.first_name, i.middle_name, i.last_name,
+                c.id, c.subject, c.course_no, c.title,
+                t.year, t.semester
+        FROM teaching t
+        INNER JOIN instructor i ON t.instructor_id = i.id
+        INNER JOIN course c ON t.course_id = c.id
+        WHERE TRUE"""
+
+TEACHING_FILTERS = (
+    ('after', 't.id > {}'),
+    ('year', 't.year = {}'),
+    ('semester', 't.semester = {}'),
+    ('instructor_id', 't.instructor_id = ANY({})'),
+    ('course_id', 't.course_id = ANY({})'),
+)
+
+REVIEW_SELECT = """\
+        SELECT  f.id,
+                f.instructor_id, f.email, f.first_name, f.middle_name, f.last_name,
+                f.course_id, f.subject, f.course_no, f.title,
+                f.year, f.semester,
+                f.instructor_rating, f.difficulty_rating, f.comment
+        FROM review_feed f
+        WHERE TRUE"""
+
+# backed by review_feed's (instructor_id, year, semester) and
+# (course_id, year, semester) indexes
+REVIEW_FILTERS = (
+    ('after', 'f.id > {}'),
+    ('year', 'f.year = {}'),
+    ('semester', 'f.semester = {}'),
+    ('instructor_id', 'f.instructor_id = ANY({})'),
+    ('course_id', 'f.course_id = ANY({})'),
+)
+
+_statements: Dict[Tuple[str, int], Statement] = dict()
+
+
+def statement(kind: str, args: Dict[str, object]) -> Tuple[Statement, List]:
+    select, order, filters = {
+        'teaching': (TEACHING_SELECT, 't.id', TEACHING_FILTERS),
+        'review': (REVIEW_SELECT, 'f.id', REVIEW_FILTERS),
+    }[kind]
+
+    present = [(i, f) for i, f in enumerate(filters) if args.get(f[0]) is not None]
+    mask = sum(1 << i for i, _ in present)
+
+    key = (kind, mask)
+    if key not in _statements:
+        _statements[key] = Statement(f'{kind}_{mask}', select, order, [f for _, f in present])
+    return _statements[key], [args[name] for _, (name, _) in present]
+
+
+def execute(cur, stmt: Statement, params: List, limit: int):
+    conn = cur.connection
+    for retry in (False, True):
+        try:
+            if stmt.name not in conn.prepared:
+                cur.execute(f"PREPARE {stmt.name} AS {stmt.prepare_sql()}")
+                conn.prepared.add(stmt.name)
+
+            placeholders = ', '.join(['%s'] * (len(params) + 1))
+            cur.execute(f"EXECUTE {stmt.name} ({placeholders})", (*params, limit))
+            return
+        except (errors.InvalidSqlStatementName, errors.DuplicatePreparedStatement):
+            # the session and our bookkeeping disagree; start over
+            conn.rollback()
+            cur.execute("DEALLOCATE ALL")
+            conn.prepared.clear()
+            if retry:
+                raise
+
+
+# Postgres plans a prepared statement's first five executions with the
+# actual values, and may settle on a generic plan after that
+CUSTOM_PLANS = 5
+
+
+def explain(cur, stmt: Statement, params: List, limit: int) -> dict:
+    # the plan of the PREPAREd statement as the API runs it, once it has
+    # been executed often enough to have picked its long-term plan
+    for _ in range(CUSTOM_PLANS + 1):
+        execute(cur, stmt, params, limit)
+        cur.fetchall()
+    placeholders = ', '.join(['%s'] * (len(params) + 1))
+    cur.execute(f"EXPLAIN (ANALYZE, FORMAT JSON) EXECUTE {stmt.name} ({placeholders})",
+                (*params, limit))
+    return cur.fetchone()[0][0]['Plan']
+
+
+def index_scans(plan: dict) -> Dict[str, str]:
+    # relation -> index for every index-backed scan in the plan
+    scans = dict()
+    if plan.get('Index Name') and plan.get('Relation Name'):
+        scans[plan['Relation Name']] = plan['Index Name']
+    for child in plan.get('Plans', ()):
+        if plan['Node Type'] == 'Bitmap Heap Scan' and child.get('Index Name'):
+            scans[plan['Relation Name']] = child['Index Name']
+        scans.update(index_scans(child))
+    return scans
+
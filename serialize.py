@@ -0,0 +1,83 @@
+import json
+import os
+from typing import Callable, Iterable, List, Sequence
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+json_encoder = os.environ.get('json_encoder', 'json')
+
+# A schema lists a row's fields in column order; a (name, schema) pair nests
+# the next columns under name.
+INSTRUCTOR = ('id', 'email', 'first_name', 'middle_name', 'last_name')
+COURSE = ('id', 'subject', 'course_no', 'title')
+TEACHING = ('id', ('instructor', INSTRUCTOR), ('course', COURSE), 'year', 'semester')
+REVIEW = ('id',
+          ('teaching', (('instructor', INSTRUCTOR), ('course', COURSE), 'year', 'semester')),
+          'instructor_rating', 'difficulty_rating', 'comment')
+
+
+def _source(schema: Sequence, index: int = 0):
+    items = []
+    for field in schema:
+        if isinstance(field, tuple):
+            name, nested = field
+            source, index = _source(nested, index)
+        else:
+            name, source = field, f'r[{index}]'
+            index += 1
+        items.append((name, f'{name!r}: {source}'))
+    # keys are emitted sorted so dumps() doesn't have to sort every row
+    return '{' + ', '.join(item for _, item in sorted(items)) + '}', index
+
+
+def row_mapper(schema: Sequence) -> Callable[[tuple], dict]:
+    # compiles the schema into a single dict display, which avoids walking
+    # the schema for every row; the source only ever comes from the schema
+    # constants below, and benchmark.py serialize times it against an
+    # itemgetter mapper
+    source, _ = _source(schema)
+    return eval(f'lambda r: {source}')
+
+
+def columns(schema: Sequence, prefix: str = '') -> List[str]:
+    names = []
+    for field in schema:
+        if isinstance(field, tuple):
+            name, nested = field
+            names.extend(columns(nested, f'{prefix}{name}.'))
+        else:
+            names.append(f'{prefix}{field}')
+    return names
+
+
+def to_columns(schema: Sequence, rows: Iterable[tuple]) -> dict:
+    return dict(sorted(zip(columns(schema), (list(column) for column in zip(*rows)))))
+
+
+# dumps() expects dicts whose keys are already sorted (as the row mappers
+# and json_response produce), so its output matches Flask's sort_keys
+# responses byte for byte without re-sorting every row
+if json_encoder == 'orjson':
+    import orjson
+
+    def dumps(obj) -> bytes:
+        # UTF-8 output, unlike the ASCII-escaped default below
+        return orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE)
+else:
+    _encoder = json.JSONEncoder(separators=(',', ':'), ensure_ascii=True)
+
+    def dumps(obj) -> bytes:
+        # same settings as Flask's default JSON responses
+        return (_encoder.encode(obj) + '\n').encode('utf-8')
+
+
+def json_response(obj: dict, status: int = 200):
+    return dumps(dict(sorted(obj.items()))), status, {'Content-Type': 'application/json'}
+
+
+instructor_json = row_mapper(INSTRUCTOR)
+course_json = row_mapper(COURSE)
+teaching_json = row_mapper(TEACHING)
+review_json = row_mapper(REVIEW)
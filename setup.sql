@@ -4,10 +4,20 @@
 -- author: Albert You
 
 
-CREATE TYPE SEMESTER AS ENUM ('S', 'F', 'X');
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
 
 
-CREATE DOMAIN RATING INT CHECK (VALUE BETWEEN 1 AND 5);
+-- types have no IF NOT EXISTS; the guards keep the script re-runnable
+DO $$ BEGIN
+	CREATE TYPE SEMESTER AS ENUM ('S', 'F', 'X');
+EXCEPTION WHEN duplicate_object THEN NULL;
+END $$;
+
+
+DO $$ BEGIN
+	CREATE DOMAIN RATING INT CHECK (VALUE BETWEEN 1 AND 5);
+EXCEPTION WHEN duplicate_object THEN NULL;
+END $$;
 
 
 CREATE TABLE IF NOT EXISTS user_info (
@@ -16,10 +26,15 @@ CREATE TABLE IF NOT EXISTS user_info (
     token CHAR(32) UNIQUE,
     password CHAR(64),
     salt CHAR(64),
+    hash_scheme VARCHAR(64),
   	PRIMARY KEY (id)
 );
 
 
+-- NULL hash_scheme is the original pbkdf2_sha256$100000 format
+ALTER TABLE user_info ADD COLUMN IF NOT EXISTS hash_scheme VARCHAR(64);
+
+
 CREATE TABLE IF NOT EXISTS course (
 	id INT GENERATED ALWAYS AS IDENTITY,
   	subject CHAR(4),
@@ -40,6 +55,17 @@ CREATE TABLE IF NOT EXISTS instructor (
 );
 
 
+-- Trigram indexes for the q= search mode and ILIKE filters on /course and /instructor
+CREATE INDEX IF NOT EXISTS course_title_trgm
+	ON course USING GIN (title gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS course_code_trgm
+	ON course USING GIN ((subject || course_no) gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS instructor_name_trgm
+	ON instructor USING GIN ((first_name || ' ' || last_name) gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS instructor_email_trgm
+	ON instructor USING GIN (email gin_trgm_ops);
+
+
 CREATE TABLE IF NOT EXISTS teaching (
 	id INT GENERATED ALWAYS AS IDENTITY,
   	instructor_id INT,
@@ -59,6 +85,22 @@ CREATE TABLE IF NOT EXISTS teaching (
 );
 
 
+-- Content hash of each subject's scraped sections, used to skip unchanged
+-- subjects on a term refresh
+CREATE TABLE IF NOT EXISTS term_fingerprint (
+	year CHAR(4),
+	semester SEMESTER,
+	subject CHAR(4),
+	digest CHAR(64),
+	PRIMARY KEY (year, semester, subject)
+);
+
+
+-- teaching(instructor_id) lookups use the UNIQUE (instructor_id, ...) index
+CREATE INDEX IF NOT EXISTS teaching_course_id ON teaching (course_id);
+CREATE INDEX IF NOT EXISTS teaching_term ON teaching (year, semester);
+
+
 CREATE TABLE IF NOT EXISTS review (
   	id INT GENERATED ALWAYS AS IDENTITY,
     user_id INT,
@@ -77,3 +119,244 @@ CREATE TABLE IF NOT EXISTS review (
   			REFERENCES teaching (id)
   			ON DELETE CASCADE
 );
+
+
+CREATE INDEX IF NOT EXISTS review_teaching_id ON review (teaching_id);
+
+
+-- Data versions behind the ETags; bumped by database.update() per term
+-- ('catalog:2021F') and overall ('catalog'), and by app.py for reviews
+-- ('review')
+CREATE TABLE IF NOT EXISTS data_version (
+	name VARCHAR(64),
+	version BIGINT NOT NULL DEFAULT 0,
+	PRIMARY KEY (name)
+);
+
+
+-- data_version('review') is bumped by app.py once reviews have committed;
+-- a trigger bumping it inside each review transaction would hold the row
+-- lock until commit and serialize every review write
+DROP TRIGGER IF EXISTS review_data_version ON review;
+DROP FUNCTION IF EXISTS review_data_version();
+
+
+-- Term update jobs (jobs.JobScheduler), shared by every serving process so
+-- any of them can report on a job and submissions dedupe across them.
+-- Times are epoch seconds, as the API reports them.
+CREATE TABLE IF NOT EXISTS update_job (
+	id CHAR(32),
+	year CHAR(4) NOT NULL,
+	semester SEMESTER NOT NULL,
+	status VARCHAR(16) NOT NULL,
+	created DOUBLE PRECISION NOT NULL,
+	started DOUBLE PRECISION,
+	finished DOUBLE PRECISION,
+	stages JSON NOT NULL DEFAULT '{}',
+	report JSON,
+	error TEXT,
+	PRIMARY KEY (id)
+);
+
+
+CREATE INDEX IF NOT EXISTS update_job_term ON update_job (year, semester, created);
+CREATE INDEX IF NOT EXISTS update_job_created ON update_job (created);
+
+
+-- Per instructor/course/teaching rating summaries, kept current by a trigger
+-- on review so the stats endpoints never aggregate over review.
+-- scope: 'I' instructor, 'C' course, 'T' teaching
+CREATE TABLE IF NOT EXISTS rating_summary (
+	scope CHAR(1),
+	target_id INT,
+	review_count INT NOT NULL DEFAULT 0,
+	instructor_rating_sum INT NOT NULL DEFAULT 0,
+	difficulty_rating_sum INT NOT NULL DEFAULT 0,
+	instructor_histogram INT[] NOT NULL DEFAULT '{0,0,0,0,0}',
+	difficulty_histogram INT[] NOT NULL DEFAULT '{0,0,0,0,0}',
+	PRIMARY KEY (scope, target_id)
+);
+
+
+CREATE OR REPLACE FUNCTION apply_rating_summary(
+	_teaching_id INT, _instructor_rating INT, _difficulty_rating INT, _delta INT
+) RETURNS VOID AS $$
+BEGIN
+	INSERT INTO rating_summary (scope, target_id)
+	SELECT s.scope, s.target_id
+	FROM teaching t,
+		LATERAL (VALUES ('T', t.id), ('I', t.instructor_id), ('C', t.course_id)) s (scope, target_id)
+	WHERE t.id = _teaching_id
+	ON CONFLICT DO NOTHING;
+
+	UPDATE rating_summary rs SET
+		review_count = rs.review_count + _delta,
+		instructor_rating_sum = rs.instructor_rating_sum + _delta * _instructor_rating,
+		difficulty_rating_sum = rs.difficulty_rating_sum + _delta * _difficulty_rating,
+		instructor_histogram[_instructor_rating] = rs.instructor_histogram[_instructor_rating] + _delta,
+		difficulty_histogram[_difficulty_rating] = rs.difficulty_histogram[_difficulty_rating] + _delta
+	FROM teaching t
+	WHERE t.id = _teaching_id
+	AND (rs.scope, rs.target_id) IN (('T', t.id), ('I', t.instructor_id), ('C', t.course_id));
+END;
+$$ LANGUAGE plpgsql;
+
+
+CREATE OR REPLACE FUNCTION review_rating_summary() RETURNS TRIGGER AS $$
+BEGIN
+	IF TG_OP IN ('UPDATE', 'DELETE') THEN
+		PERFORM apply_rating_summary(OLD.teaching_id, OLD.instructor_rating, OLD.difficulty_rating, -1);
+	END IF;
+	IF TG_OP IN ('INSERT', 'UPDATE') THEN
+		PERFORM apply_rating_summary(NEW.teaching_id, NEW.instructor_rating, NEW.difficulty_rating, 1);
+	END IF;
+	RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+
+DROP TRIGGER IF EXISTS review_rating_summary ON review;
+CREATE TRIGGER review_rating_summary
+	AFTER INSERT OR UPDATE OR DELETE ON review
+	FOR EACH ROW EXECUTE FUNCTION review_rating_summary();
+
+
+-- backfill reviews written before the trigger existed; recomputed in full,
+-- so summaries the trigger started from zero are corrected too
+INSERT INTO rating_summary (scope, target_id, review_count,
+							instructor_rating_sum, difficulty_rating_sum,
+							instructor_histogram, difficulty_histogram)
+SELECT  s.scope, s.target_id, COUNT(*),
+		SUM(r.instructor_rating), SUM(r.difficulty_rating),
+		ARRAY[COUNT(*) FILTER (WHERE r.instructor_rating = 1), COUNT(*) FILTER (WHERE r.instructor_rating = 2),
+			  COUNT(*) FILTER (WHERE r.instructor_rating = 3), COUNT(*) FILTER (WHERE r.instructor_rating = 4),
+			  COUNT(*) FILTER (WHERE r.instructor_rating = 5)],
+		ARRAY[COUNT(*) FILTER (WHERE r.difficulty_rating = 1), COUNT(*) FILTER (WHERE r.difficulty_rating = 2),
+			  COUNT(*) FILTER (WHERE r.difficulty_rating = 3), COUNT(*) FILTER (WHERE r.difficulty_rating = 4),
+			  COUNT(*) FILTER (WHERE r.difficulty_rating = 5)]
+FROM review r
+INNER JOIN teaching t ON t.id = r.teaching_id,
+LATERAL (VALUES ('T', t.id), ('I', t.instructor_id), ('C', t.course_id)) s (scope, target_id)
+GROUP BY s.scope, s.target_id
+ON CONFLICT (scope, target_id) DO UPDATE SET
+	review_count = EXCLUDED.review_count,
+	instructor_rating_sum = EXCLUDED.instructor_rating_sum,
+	difficulty_rating_sum = EXCLUDED.difficulty_rating_sum,
+	instructor_histogram = EXCLUDED.instructor_histogram,
+	difficulty_histogram = EXCLUDED.difficulty_histogram;
+
+
+-- Denormalized /review rows: one per review with its teaching's instructor,
+-- course and term, so the feed is read without joins. Kept current by the
+-- triggers below on review, instructor and course.
+CREATE TABLE IF NOT EXISTS review_feed (
+	id INT,
+	instructor_id INT,
+	email VARCHAR(255),
+	first_name VARCHAR(255),
+	middle_name VARCHAR(255),
+	last_name VARCHAR(255),
+	course_id INT,
+	subject CHAR(4),
+	course_no CHAR(5),
+	title VARCHAR(255),
+	year CHAR(4),
+	semester SEMESTER,
+	instructor_rating INT,
+	difficulty_rating INT,
+	comment TEXT,
+	PRIMARY KEY (id),
+	CONSTRAINT fk_review
+		FOREIGN KEY (id)
+			REFERENCES review (id)
+			ON DELETE CASCADE
+);
+
+
+CREATE INDEX IF NOT EXISTS review_feed_instructor ON review_feed (instructor_id, year, semester);
+CREATE INDEX IF NOT EXISTS review_feed_course ON review_feed (course_id, year, semester);
+
+
+CREATE OR REPLACE FUNCTION review_feed_review() RETURNS TRIGGER AS $$
+BEGIN
+	INSERT INTO review_feed
+	SELECT  NEW.id,
+			i.id, i.email, i.first_name, i.middle_name, i.last_name,
+			c.id, c.subject, c.course_no, c.title,
+			t.year, t.semester,
+			NEW.instructor_rating, NEW.difficulty_rating, NEW.comment
+	FROM teaching t
+	INNER JOIN instructor i ON t.instructor_id = i.id
+	INNER JOIN course c ON t.course_id = c.id
+	WHERE t.id = NEW.teaching_id
+	ON CONFLICT (id) DO UPDATE SET
+		instructor_id = EXCLUDED.instructor_id, email = EXCLUDED.email,
+		first_name = EXCLUDED.first_name, middle_name = EXCLUDED.middle_name,
+		last_name = EXCLUDED.last_name, course_id = EXCLUDED.course_id,
+		subject = EXCLUDED.subject, course_no = EXCLUDED.course_no, title = EXCLUDED.title,
+		year = EXCLUDED.year, semester = EXCLUDED.semester,
+		instructor_rating = EXCLUDED.instructor_rating,
+		difficulty_rating = EXCLUDED.difficulty_rating, comment = EXCLUDED.comment;
+	RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+
+DROP TRIGGER IF EXISTS review_feed_review ON review;
+CREATE TRIGGER review_feed_review
+	AFTER INSERT OR UPDATE ON review
+	FOR EACH ROW EXECUTE FUNCTION review_feed_review();
+
+
+-- term updates rename instructors and retitle courses in place
+CREATE OR REPLACE FUNCTION review_feed_instructor() RETURNS TRIGGER AS $$
+BEGIN
+	UPDATE review_feed SET
+		email = NEW.email, first_name = NEW.first_name,
+		middle_name = NEW.middle_name, last_name = NEW.last_name
+	WHERE instructor_id = NEW.id;
+	RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+
+DROP TRIGGER IF EXISTS review_feed_instructor ON instructor;
+CREATE TRIGGER review_feed_instructor
+	AFTER UPDATE ON instructor
+	FOR EACH ROW
+	WHEN ((OLD.email, OLD.first_name, OLD.middle_name, OLD.last_name)
+		IS DISTINCT FROM (NEW.email, NEW.first_name, NEW.middle_name, NEW.last_name))
+	EXECUTE FUNCTION review_feed_instructor();
+
+
+CREATE OR REPLACE FUNCTION review_feed_course() RETURNS TRIGGER AS $$
+BEGIN
+	UPDATE review_feed SET
+		subject = NEW.subject, course_no = NEW.course_no, title = NEW.title
+	WHERE course_id = NEW.id;
+	RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+
+DROP TRIGGER IF EXISTS review_feed_course ON course;
+CREATE TRIGGER review_feed_course
+	AFTER UPDATE ON course
+	FOR EACH ROW
+	WHEN ((OLD.subject, OLD.course_no, OLD.title)
+		IS DISTINCT FROM (NEW.subject, NEW.course_no, NEW.title))
+	EXECUTE FUNCTION review_feed_course();
+
+
+-- backfill reviews written before review_feed existed
+INSERT INTO review_feed
+SELECT  r.id,
+		i.id, i.email, i.first_name, i.middle_name, i.last_name,
+		c.id, c.subject, c.course_no, c.title,
+		t.year, t.semester,
+		r.instructor_rating, r.difficulty_rating, r.comment
+FROM review r
+INNER JOIN teaching t ON t.id = r.teaching_id
+INNER JOIN instructor i ON t.instructor_id = i.id
+INNER JOIN course c ON t.course_id = c.id
+ON CONFLICT (id) DO NOTHING;
@@ -0,0 +1,160 @@
+import glob
+import gzip
+import logging
+import mmap
+import os
+import re
+import threading
+from array import array
+from bisect import bisect_right
+from typing import Dict, Iterator, Optional, Tuple
+
+import queries
+from serialize import dumps, teaching_json
+from versions import DataVersions
+
+# Per-term teaching snapshots, written by database.update() once a term has
+# been ingested. Each version of a term is three files:
+#   teaching-2021F-v3.ndjson     one teaching per line (instructor and course
+#                                embedded), exactly as /teaching serializes
+#                                them, in id order; the API mmaps this
+#   teaching-2021F-v3.ndjson.gz  the same, to publish or download elsewhere
+#   teaching-2021F-v3.idx        int64 ids, then the byte offset of every line
+#                                plus the end of the file
+# The version is the term's 'catalog:2021F' data version, so a snapshot is
+# only served while it matches what the database says is current.
+
+FILE_NAME = re.compile(r'teaching-(\d{4})([A-Z])-v(\d+)\.ndjson$')
+CHUNK_SIZE = 64 * 1024
+
+
+class TermSnapshot:
+    __slots__ = ('version', 'ids', 'offsets', 'data')
+
+    def __init__(self, path: str, version: int) -> None:
+        self.version = version
+
+        index = array('q')
+        with open(path[:-len('.ndjson')] + '.idx', 'rb') as f:
+            index.frombytes(f.read())
+        count = len(index) // 2
+        self.ids = index[:count]
+        self.offsets = index[count:]
+
+        with open(path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def page(self, after: int, limit: int) -> Tuple[bytes, int, Optional[int]]:
+        # the serialized rows with id > after, comma-joined, their count and
+        # the next cursor, as the keyset query would page them
+        start = bisect_right(self.ids, after)
+        end = min(start + limit, len(self.ids))
+        if start >= end:
+            return b'', 0, None
+        next_id = self.ids[end - 1] if end < len(self.ids) else None
+        # lines never contain a raw newline, so it can become the separator
+        rows = self.data[self.offsets[start]:self.offsets[end] - 1].replace(b'\n', b',')
+        return rows, end - start, next_id
+
+    def rows(self, after: int) -> Iterator[bytes]:
+        # ndjson, from the row after the cursor to the end of the term, a
+        # chunk at a time rather than one copy of the rest of the file
+        data = self.data
+        for offset in range(self.offsets[bisect_right(self.ids, after)], len(data), CHUNK_SIZE):
+            yield data[offset:offset + CHUNK_SIZE]
+
+    def warm(self):
+        # fault the pages in ahead of the first request
+        if hasattr(self.data, 'madvise'):
+            self.data.madvise(mmap.MADV_WILLNEED)
+
+
+class Snapshots:
+    def __init__(self, directory: str, versions: DataVersions) -> None:
+        self.directory = directory
+        self.versions = versions
+
+        self._terms: Dict[str, TermSnapshot] = dict()
+        self._lock = threading.Lock()
+
+    def path(self, term: str, version: int) -> str:
+        return os.path.join(self.directory, f'teaching-{term}-v{version}.ndjson')
+
+    def get(self, year: str, semester_enum: str) -> Optional[TermSnapshot]:
+        # None when the term has no snapshot for its current version; the
+        # caller falls back to SQL
+        term = f'{year}{semester_enum}'
+        version, = self.versions.get((f'catalog:{term}',))
+        snapshot = self._terms.get(term)
+        if snapshot is not None and snapshot.version == version:
+            return snapshot
+        if not version:
+            return None
+
+        path = self.path(term, version)
+        if not os.path.exists(path):
+            return None
+        with self._lock:
+            snapshot = self._terms.get(term)
+            if snapshot is None or snapshot.version != version:
+                snapshot = self._terms[term] = TermSnapshot(path, version)
+        return snapshot
+
+    def warm(self):
+        # maps the newest snapshot of every term on disk; get() still checks
+        # each against the database before serving it
+        newest = dict()
+        for path in glob.glob(os.path.join(self.directory, 'teaching-*.ndjson')):
+            match = FILE_NAME.search(os.path.basename(path))
+            if match:
+                term, version = match[1] + match[2], int(match[3])
+                if version > newest.get(term, (0, None))[0]:
+                    newest[term] = version, path
+
+        with self._lock:
+            for term, (version, path) in newest.items():
+                if term not in self._terms or self._terms[term].version < version:
+                    self._terms[term] = TermSnapshot(path, version)
+                self._terms[term].warm()
+        return len(newest)
+
+    def write(self, conn, year: str, semester_enum: str) -> Optional[str]:
+        term = f'{year}{semester_enum}'
+        stmt, params = queries.statement('teaching', {'after': 0, 'year': year,
+                                                      'semester': semester_enum})
+        with conn.cursor() as cur:
+            cur.execute("SELECT version FROM data_version WHERE name=%s;", (f'catalog:{term}',))
+            result = cur.fetchone()
+            cur.execute(stmt.sql() + ";", params)
+            rows = cur.fetchall()
+        conn.rollback()
+        if result is None or not rows:
+            return None
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(term, result[0])
+        base = path[:-len('.ndjson')]
+        ids, offsets = array('q'), array('q', [0])
+        with open(path + '.tmp', 'wb') as f, gzip.open(path + '.gz.tmp', 'wb') as gz:
+            for row in rows:
+                line = dumps(teaching_json(row))
+                f.write(line)
+                gz.write(line)
+                ids.append(row[0])
+                offsets.append(offsets[-1] + len(line))
+        with open(base + '.idx.tmp', 'wb') as f:
+            f.write(ids.tobytes() + offsets.tobytes())
+
+        # the index and data are in place before readers can find the file
+        os.replace(base + '.idx.tmp', base + '.idx')
+        os.replace(path + '.gz.tmp', path + '.gz')
+        os.replace(path + '.tmp', path)
+
+        # older versions of the term; processes that still map one keep it
+        for old in glob.glob(os.path.join(self.directory, f'teaching-{term}-v*')):
+            match = re.search(r'-v(\d+)\.', os.path.basename(old))
+            if match and int(match[1]) < result[0]:
+                os.remove(old)
+
+        logging.debug('snapshot term=%s version=%s rows=%s', term, result[0], len(rows))
+        return path
@@ -0,0 +1,44 @@
+import os
+
+import pytest
+
+from course import iter_sections, parse_sections
+from exception import InvalidTerm
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+CHUNK_SIZES = [1, 2, 3, 7, 64, 4096]
+
+
+def _read(name: str) -> str:
+    with open(os.path.join(FIXTURES, name), 'r') as file:
+        return file.read()
+
+
+def _chunks(html: str, size: int):
+    for i in range(0, len(html), size):
+        yield html[i:i + size]
+
+
+def test_fixture_sections():
+    # the unparsable 'Staff' link is skipped, the nested meeting times table
+    # doesn't end the listing
+    assert parse_sections(_read('sections.html')) == {
+        ('CSCI', '1302', 'Software Development', 'mepcott@uga.edu', 'Michael', 'E.', 'Cotterell'),
+        ('CSCI', '1302', 'Software Development', 'bjb211@uga.edu', 'Bradley', '', 'Barnes'),
+        ('CSCI', '2720', 'Data Structures & Algorithms', 'jdoe@uga.edu', 'Jane', '', 'Doe'),
+    }
+
+
+@pytest.mark.parametrize('size', CHUNK_SIZES)
+def test_iter_sections_matches_parse_sections(size):
+    html = _read('sections.html')
+    assert set(iter_sections(_chunks(html, size))) == parse_sections(html)
+
+
+@pytest.mark.parametrize('size', CHUNK_SIZES)
+def test_invalid_term(size):
+    html = _read('invalid_term.html')
+    with pytest.raises(InvalidTerm):
+        parse_sections(html, '2021', 'F')
+    with pytest.raises(InvalidTerm):
+        list(iter_sections(_chunks(html, size), '2021', 'F'))
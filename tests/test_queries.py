@@ -0,0 +1,35 @@
+import json
+
+import psycopg2 as pg
+import pytest
+
+import database
+from queries import explain, index_scans, statement
+
+# Plan regression check against the configured (seeded) database; run
+# ANALYZE on it first if its statistics are stale
+CASES = [
+    ('teaching', {'after': 0, 'course_id': [1]}, 'teaching'),
+    ('teaching', {'after': 0, 'instructor_id': [1]}, 'teaching'),
+    ('review', {'after': 0, 'course_id': [1]}, 'review_feed'),
+    ('review', {'after': 0, 'instructor_id': [1]}, 'review_feed'),
+    ('review', {'after': 0, 'instructor_id': [1], 'year': '2021', 'semester': 'F'},
+     'review_feed'),
+]
+
+
+@pytest.fixture(scope='module')
+def cursor():
+    try:
+        with database.connection() as conn, conn.cursor() as cur:
+            yield cur
+    except pg.OperationalError as e:
+        pytest.skip(f'no database: {e}')
+
+
+@pytest.mark.parametrize('kind, args, relation', CASES)
+def test_plan_uses_index(cursor, kind, args, relation):
+    stmt, params = statement(kind, args)
+    plan = explain(cursor, stmt, params, 100)
+    assert 'Index' in json.dumps(plan)
+    assert relation in index_scans(plan)
@@ -0,0 +1,81 @@
+import hashlib
+import threading
+import time
+from functools import wraps
+from typing import Callable, Iterable, Tuple
+
+from flask import g, make_response, request
+
+
+class DataVersions:
+    def __init__(self, connect: Callable, ttl: float) -> None:
+        self.connect = connect
+        self.ttl = ttl
+
+        self._versions = dict()
+        self._loaded = 0
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        with self.connect() as conn, conn.cursor() as cur:
+            cur.execute("SELECT name, version FROM data_version;")
+            versions = dict(cur.fetchall())
+        with self._lock:
+            self._versions = versions
+            self._loaded = time.monotonic()
+
+    def stale(self, margin: float = 0) -> bool:
+        return time.monotonic() - self._loaded > self.ttl - margin
+
+    def get(self, names: Iterable[str]) -> Tuple[int, ...]:
+        if self.stale():
+            self.refresh()
+        versions = self._versions
+        return tuple(versions.get(name, 0) for name in names)
+
+    def expire(self):
+        with self._lock:
+            self._loaded = 0
+
+    def bump(self, conn, names: Iterable[str]):
+        # commits, along with whatever changed the data in this transaction
+        with conn.cursor() as cur:
+            query = """\
+                INSERT INTO data_version (name, version)
+                SELECT unnest(%s::VARCHAR[]), 1
+                ON CONFLICT (name) DO UPDATE SET version = data_version.version + 1;"""
+            cur.execute(query, (list(names),))
+        conn.commit()
+        self.expire()
+
+
+def etag(path: str, args, version: Tuple[int, ...]) -> str:
+    key = repr((path, sorted(args.items(multi=True)), version))
+    return hashlib.blake2b(key.encode('utf-8'), digest_size=12).hexdigest()
+
+
+def conditional(versions: DataVersions, names: Callable, max_age: int):
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if g.get('read_primary'):
+                # versions come from the replicas, which may not have the
+                # caller's own write yet
+                return f(*args, **kwargs)
+
+            version = versions.get(names(request.args))
+            # response_cache keys on it, so a body cached under an older
+            # version is never sent with this one's ETag
+            g.data_version = version
+            tag = etag(request.path, request.args, version)
+            headers = {'ETag': f'"{tag}"', 'Cache-Control': f'public, max-age={max_age}'}
+
+            if request.if_none_match.contains_weak(tag):
+                return '', 304, headers
+
+            response = make_response(f(*args, **kwargs))
+            if response.status_code == 200:
+                response.headers.update(headers)
+            return response
+        return wrapper
+    return decorator